@@ -0,0 +1,200 @@
+"""
+Collects the benchmark files Snakemake writes for every rule into per stage tables of wall time, CPU time, peak memory
+and throughput. Throughput is normalised by the reads each job took in, read from the logs of bbduk, bbmerge, bbmap,
+trim_primers and vsearch, so plates of different depth can be compared and regressions tracked between runs.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import csv
+import os
+import re
+import statistics
+
+# Log of each rule and the pattern of the number of reads it took in. Rules without one are normalised by the reads
+# trim_primers counted for the sample
+SAMPLE_READS = ("slice.{}.log", re.compile(r"Total Reads: (\d+)"))
+STAGE_READS = {
+    "bbduk": ("bbduk.{}.log", re.compile(r"Input:\s+(\d+) reads")),
+    "bbmerge": ("bbmerge.{}.log", re.compile(r"Pairs:\s+(\d+)")),
+    "remove_primers": SAMPLE_READS,
+    "stream_trim": SAMPLE_READS,
+    "vsearch": ("vsearch.{}.log", re.compile(r"\d+ nt in (\d+) seqs")),
+    "map_reads": ("bbmap.{}.log", re.compile(r"Reads Used:\s+(\d+)")),
+}
+
+# Benchmarks named after a chunk of samples list them in the chunk's log
+CHUNK_SAMPLES = re.compile(r"^Samples: (.*)$", re.MULTILINE)
+
+JOB_HEADER = ["stage", "job", "reads", "wall_s", "cpu_s", "max_rss_mb", "reads_per_s", "wall_s_per_million_reads"]
+STAGE_HEADER = ["stage", "jobs", "reads", "wall_s", "cpu_s", "median_max_rss_mb", "max_rss_mb", "reads_per_s",
+                "wall_s_per_million_reads"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarises Snakemake benchmark files per stage')
+    parser.add_argument('-b', type=str,
+                        help='Directory of benchmark files', default="benchmarks")
+    parser.add_argument('-l', type=str,
+                        help='Directory of log files', default="logs")
+    parser.add_argument('-j', type=str,
+                        help='Table of every job', default="Benchmark_Jobs.tsv")
+    parser.add_argument('-o', type=str,
+                        help='Table of every stage', default="Benchmark_Summary.tsv")
+    args = parser.parse_args()
+
+    jobs = collect_jobs(args.b, args.l)
+    stages = summarise_stages(jobs)
+    write_table(args.j, JOB_HEADER, jobs)
+    write_table(args.o, STAGE_HEADER, stages)
+    print_table(STAGE_HEADER, stages)
+
+
+def collect_jobs(benchmark_directory, log_directory):
+    """
+    Reads every benchmark file, named rule.job.tsv where job is a sample, the name of a chunk's log or plate for rules
+    run once per plate. Repeated measurements in a file are averaged.
+    :return: List of dictionaries of JOB_HEADER columns, sorted by stage and job
+    """
+    jobs = []
+    if not os.path.isdir(benchmark_directory):
+        return jobs
+    for name in sorted(os.listdir(benchmark_directory)):
+        if not name.endswith(".tsv"):
+            continue
+        stage, _, job = name[:-len(".tsv")].partition(".")
+        with open(os.path.join(benchmark_directory, name)) as f:
+            rows = list(csv.DictReader(f, delimiter="\t"))
+        if not rows:
+            continue
+        wall = mean_of(rows, "s")
+        cpu = mean_of(rows, "cpu_time")
+        rss = mean_of(rows, "max_rss")
+        reads = job_reads(stage, job, log_directory)
+        jobs.append({
+            "stage": stage,
+            "job": job,
+            "reads": reads,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "max_rss_mb": rss,
+            "reads_per_s": reads / wall if reads is not None and wall else None,
+            "wall_s_per_million_reads": wall * 1e6 / reads if reads and wall is not None else None,
+        })
+    return jobs
+
+
+def mean_of(rows, column):
+    # Mean of a numeric column, None if the column is missing or Snakemake couldn't measure it
+    values = []
+    for row in rows:
+        try:
+            values.append(float(row[column]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return sum(values) / len(values) if values else None
+
+
+def read_count(log_file, pattern):
+    try:
+        with open(log_file) as f:
+            match = pattern.search(f.read())
+    except (IOError, OSError):
+        return None
+    return int(match.group(1)) if match else None
+
+
+def job_reads(stage, job, log_directory):
+    """
+    Reads a job took in. A stage's own log is used where it reports its input, otherwise the reads trim_primers
+    counted for the sample. Chunks and plate level steps are given the reads of every sample they covered.
+    """
+    log_name, pattern = STAGE_READS.get(stage, SAMPLE_READS)
+    reads = read_count(os.path.join(log_directory, log_name.format(job)), pattern)
+    if reads is not None or stage in STAGE_READS:
+        return reads
+
+    samples = chunk_samples(os.path.join(log_directory, "{}.log".format(job)))
+    if samples is None:
+        samples = plate_samples(log_directory)
+    counts = [read_count(os.path.join(log_directory, SAMPLE_READS[0].format(sample)), SAMPLE_READS[1])
+              for sample in samples]
+    counts = [count for count in counts if count is not None]
+    return sum(counts) if counts else None
+
+
+def chunk_samples(log_file):
+    try:
+        with open(log_file) as f:
+            match = CHUNK_SAMPLES.search(f.read())
+    except (IOError, OSError):
+        return None
+    return match.group(1).split() if match else None
+
+
+def plate_samples(log_directory):
+    prefix, suffix = SAMPLE_READS[0].split("{}")
+    if not os.path.isdir(log_directory):
+        return []
+    return [name[len(prefix):-len(suffix)] for name in os.listdir(log_directory)
+            if name.startswith(prefix) and name.endswith(suffix)]
+
+
+def summarise_stages(jobs):
+    """
+    Totals the jobs of each stage. Throughput is the reads of every job over their summed wall time, so it is the
+    rate of a single job slot.
+    :return: List of dictionaries of STAGE_HEADER columns, in order of first appearance
+    """
+    stages = {}
+    for job in jobs:
+        stages.setdefault(job["stage"], []).append(job)
+
+    summaries = []
+    for stage, stage_jobs in stages.items():
+        walls = [job["wall_s"] for job in stage_jobs if job["wall_s"] is not None]
+        cpus = [job["cpu_s"] for job in stage_jobs if job["cpu_s"] is not None]
+        rss = [job["max_rss_mb"] for job in stage_jobs if job["max_rss_mb"] is not None]
+        counted = [job for job in stage_jobs if job["reads"] and job["wall_s"] is not None]
+        reads = sum(job["reads"] for job in counted)
+        counted_wall = sum(job["wall_s"] for job in counted)
+        summaries.append({
+            "stage": stage,
+            "jobs": len(stage_jobs),
+            "reads": reads if counted else None,
+            "wall_s": sum(walls) if walls else None,
+            "cpu_s": sum(cpus) if cpus else None,
+            "median_max_rss_mb": statistics.median(rss) if rss else None,
+            "max_rss_mb": max(rss) if rss else None,
+            "reads_per_s": reads / counted_wall if counted and counted_wall else None,
+            "wall_s_per_million_reads": counted_wall * 1e6 / reads if counted and reads else None,
+        })
+    return summaries
+
+
+def format_value(value):
+    if value is None:
+        return "NA"
+    if isinstance(value, float):
+        return "{:.2f}".format(value)
+    return str(value)
+
+
+def write_table(path, header, rows):
+    with open(path, "w") as f:
+        f.write("\t".join(header) + "\n")
+        for row in rows:
+            f.write("\t".join(format_value(row[column]) for column in header) + "\n")
+
+
+def print_table(header, rows):
+    table = [header] + [[format_value(row[column]) for column in header] for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(header))]
+    for row in table:
+        print("  ".join(value.rjust(width) if i else value.ljust(width)
+                        for i, (value, width) in enumerate(zip(row, widths))))
+
+
+if __name__ == "__main__":
+    main()
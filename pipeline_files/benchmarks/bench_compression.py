@@ -0,0 +1,80 @@
+"""
+Benchmarks the compression seq_io supports for the merged, unmerged and sliced reads. Every read of a fastq is written
+uncompressed, gzipped and zstd compressed through seq_io.open_binary, then read back with seq_io.read_fastq, reporting
+the size on disk and the time taken each way.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from simulate_amplicons import load_amplicon, simulate_reads, write_reads
+import seq_io
+from seq_io import format_fastq, open_binary, read_fastq
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks writing and reading compressed fastq with seq_io')
+    parser.add_argument('-f', type=str,
+                        help='Merged Read file in .fq format, reads are simulated if omitted')
+    parser.add_argument('-n', type=int,
+                        help='Number of reads to simulate', default=100000)
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Compression threads, where the library supports them', default=1)
+    args = parser.parse_args()
+
+    if args.f:
+        benchmark(args.f, args.threads)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            fastq_file = os.path.join(directory, "simulated.fq")
+            write_reads(simulate_reads(load_amplicon(), args.n), fastq_file)
+            benchmark(fastq_file, args.threads)
+
+
+def formats():
+    yield "plain", ".fq"
+    yield "gzip", ".fq.gz"
+    if seq_io.zstandard is not None:
+        yield "zstd", ".fq.zst"
+
+
+def benchmark(fastq_file, threads=1):
+    reads = list(read_fastq(fastq_file))
+    plain_size = None
+    if seq_io.igzip_threaded is not None:
+        gzip_library = "python-isal, threaded"
+    elif seq_io.igzip is not None:
+        gzip_library = "python-isal, single threaded"
+    else:
+        gzip_library = "gzip"
+    print("{}: {} reads, gzip by {}".format(os.path.basename(fastq_file), len(reads), gzip_library))
+    print("{:<6} {:>9} {:>7} {:>12} {:>12}".format("format", "MB", "ratio", "write s", "read s"))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, extension in formats():
+            path = os.path.join(directory, "reads" + extension)
+            start = time.perf_counter()
+            with open_binary(path, "wb", threads) as f:
+                for read in reads:
+                    f.write(format_fastq(*read))
+            written = time.perf_counter() - start
+
+            start = time.perf_counter()
+            count = sum(1 for _ in read_fastq(path))
+            read_back = time.perf_counter() - start
+            if count != len(reads):
+                print("Warning: {} read back {} of {} reads".format(name, count, len(reads)))
+
+            size = os.path.getsize(path)
+            plain_size = plain_size or size
+            print("{:<6} {:>9.1f} {:>7.2f} {:>12.3f} {:>12.3f}".format(name, size / 1e6, plain_size / size, written,
+                                                                      read_back))
+
+
+if __name__ == "__main__":
+    main()
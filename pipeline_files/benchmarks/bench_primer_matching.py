@@ -0,0 +1,87 @@
+"""
+Benchmarks detection of the degenerate fragment B reverse primer. Compares the previous approach of expanding the
+primer into every oligo (as the dg program did) and searching each read once per oligo against the compiled IUPAC
+matcher used by trim_primers.py. Reports reads per second for both.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from simulate_amplicons import PRIMERS, load_amplicon, simulate_reads
+from seq_io import IUPAC_CODES
+from trim_primers import REVERSE_PRIMER_MIN_INDEX, compile_primers, get_primers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks degenerate primer matching in trim_primers')
+    parser.add_argument('-p', type=str,
+                        help='Primer File in .fasta format', default=PRIMERS)
+    parser.add_argument('-n', type=int,
+                        help='Number of reads to simulate', default=100000)
+    parser.add_argument('--seed', type=int,
+                        help='Random seed', default=1)
+    args = parser.parse_args()
+
+    benchmark(args.p, args.n, args.seed)
+
+
+def expand_oligos(primer):
+    # Every concrete oligo of a degenerate primer, equivalent to the output of the dg program
+    return ["".join(oligo) for oligo in itertools.product(*[IUPAC_CODES[base] for base in primer.upper()])]
+
+
+def simulate(primer_file, number_of_reads, seed):
+    # Simulated merged reads, half of the usable ones fragment B reads ending in an oligo of the reverse primer
+    amplicon = load_amplicon(primer_file=primer_file)
+    return [seq for _, seq, _ in simulate_reads(amplicon, number_of_reads, seed=seed)]
+
+
+def oligo_loop(reads, oligos):
+    found = 0
+    for read in reads:
+        for primer in oligos:
+            if read.find(primer) > 400:
+                found += 1
+                break
+    return found
+
+
+def compiled_matcher(reads, pattern):
+    found = 0
+    for read in reads:
+        if pattern.search(read, REVERSE_PRIMER_MIN_INDEX):
+            found += 1
+    return found
+
+
+def benchmark(primer_file, number_of_reads, seed):
+    primer_b_r = str(get_primers(primer_file)[3].seq)
+    oligos = [oligo.encode() for oligo in expand_oligos(primer_b_r)]
+    reads = simulate(primer_file, number_of_reads, seed)
+    print("Reverse primer {} expands to {} oligos, {} reads".format(primer_b_r, len(oligos), len(reads)))
+
+    start = time.perf_counter()
+    _, pattern = compile_primers(primer_file)
+    build_time = time.perf_counter() - start
+
+    results = []
+    for name, func, arg in (("oligo loop", oligo_loop, oligos), ("compiled matcher", compiled_matcher, pattern)):
+        start = time.perf_counter()
+        found = func(reads, arg)
+        elapsed = time.perf_counter() - start
+        results.append(found)
+        print("{:<18} {:>10.0f} reads/s  ({} reads with primer, {:.3f}s)".format(name, len(reads) / elapsed,
+                                                                                found, elapsed))
+    print("Primer index built in {:.6f}s".format(build_time))
+    if results[0] != results[1]:
+        print("Warning: methods disagree on the number of primer hits")
+
+
+if __name__ == "__main__":
+    main()
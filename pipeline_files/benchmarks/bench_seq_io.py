@@ -0,0 +1,73 @@
+"""
+Benchmarks the shared seq_io reader against Bio.SeqIO on a merged read fastq. Each method parses every read, slices
+it as trim_primers.py does for a fragment A read and formats the slice back to fastq text.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from simulate_amplicons import load_amplicon, simulate_reads, write_reads
+from seq_io import format_fastq, read_fastq
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks seq_io against Bio.SeqIO')
+    parser.add_argument('-f', type=str,
+                        help='Merged Read file in .fq format, reads are simulated if omitted')
+    parser.add_argument('-n', type=int,
+                        help='Number of reads to simulate', default=100000)
+    args = parser.parse_args()
+
+    if args.f:
+        benchmark(args.f)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            fastq_file = os.path.join(directory, "simulated.fq")
+            write_reads(simulate_reads(load_amplicon(), args.n), fastq_file)
+            benchmark(fastq_file)
+
+
+def biopython(fastq_file):
+    written = 0
+    with open(fastq_file) as f:
+        for seq in SeqIO.parse(f, "fastq"):
+            written += len(seq[25:455].format("fastq"))
+    return written
+
+
+def seq_io(fastq_file):
+    written = 0
+    for header, seq, qual in read_fastq(fastq_file):
+        written += len(format_fastq(header, seq[25:455], qual[25:455]))
+    return written
+
+
+def count_reads(fastq_file):
+    return sum(1 for _ in read_fastq(fastq_file))
+
+
+def benchmark(fastq_file):
+    reads = count_reads(fastq_file)
+    print("{}: {} reads, {:.1f} MB".format(os.path.basename(fastq_file), reads,
+                                           os.path.getsize(fastq_file) / 1e6))
+    results = []
+    for name, func in (("Bio.SeqIO", biopython), ("seq_io", seq_io)):
+        start = time.perf_counter()
+        written = func(fastq_file)
+        elapsed = time.perf_counter() - start
+        results.append(written)
+        print("{:<10} {:>10.0f} reads/s  ({:.3f}s)".format(name, reads / elapsed, elapsed))
+    if results[0] != results[1]:
+        print("Warning: methods wrote a different number of bytes")
+
+
+if __name__ == "__main__":
+    main()
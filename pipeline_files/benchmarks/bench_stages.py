@@ -0,0 +1,208 @@
+"""
+Benchmarks the read processing scripts stage by stage on simulated amplicon samples. For each sample depth, reads are
+simulated with simulate_amplicons.py and run through trim_primers.py, trim_primers.py with dereplication,
+evaluate_vsearch.py, and evaluate_consensus.py over a plate of copies of the result. Every stage runs as its own
+process, as the workflow runs it, and its wall time and peak memory are reported with reads per second. Peak memory
+is sampled from /proc while the stage runs, summed over the processes it starts, so it is only measured on Linux.
+The external tools of the workflow are benchmarked too when they are on the PATH, and otherwise listed as excluded:
+bbduk and bbmerge on 2x300 read pairs cut from the simulated merged reads, and vsearch dereplicating the sliced reads
+of trim_primers.py. The python stages always run on the simulated merged reads, so their timings don't depend on which
+tools are installed.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from simulate_amplicons import PIPELINE_FILES, PRIMERS, load_amplicon, reverse_complement, simulate_reads, write_reads
+from seq_io import format_fastq, open_binary
+
+DEPTHS = [1000, 10000, 100000, 1000000]
+
+ADAPTERS = os.path.join(PIPELINE_FILES, "adapters.fa")
+
+# Length of each simulated MiSeq read of a pair
+READ_LENGTH = 300
+
+# Seconds between samples of the memory of a running stage
+SAMPLE_INTERVAL = 0.01
+
+# External tools of the workflow, benchmarked only if found on the PATH
+TOOLS = ["bbduk.sh", "bbmerge.sh", "vsearch"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks trim_primers, evaluate_vsearch, evaluate_consensus and '
+                                                 'the external tools on the PATH on simulated samples')
+    parser.add_argument('-n', type=int, nargs='+',
+                        help='Sample depths in reads', default=DEPTHS)
+    parser.add_argument('--plate', type=int,
+                        help='Number of samples evaluate_consensus summarises', default=96)
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Worker processes of trim_primers', default=1)
+    parser.add_argument('-c', '--contamination', type=float,
+                        help='Fraction of reads from a contaminant haplotype', default=0.05)
+    parser.add_argument('--seed', type=int,
+                        help='Random seed', default=1)
+    args = parser.parse_args()
+
+    benchmark(args.n, args.plate, args.threads, args.contamination, args.seed)
+
+
+def run_stage(command):
+    """
+    Runs a stage in its own process while a thread samples the peak memory of it and any processes it starts.
+    :return: Tuple of wall seconds and peak resident memory in MB of the stage's processes, None if it exited before
+    it was sampled
+    """
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr)
+        peak = [0]
+        done = threading.Event()
+
+        def sample():
+            # VmHWM is each process's own high-water mark, unlike ru_maxrss which a child inherits from the process
+            # that forked it. It only rises, so sampling misses no more than growth in the last interval
+            while not done.is_set():
+                peak[0] = max(peak[0], sum(peak_rss_kb(pid) for pid in process_tree(process.pid)))
+                done.wait(SAMPLE_INTERVAL)
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        status = process.wait()
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+        if status:
+            stderr.seek(0)
+            raise RuntimeError("{} failed: {}".format(" ".join(command), stderr.read().decode(errors="replace")))
+    return elapsed, peak[0] / 1024.0 if peak[0] else None
+
+
+def process_tree(pid):
+    # The process and its descendants, found from the parent of every process in /proc
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(name)) as f:
+                # The parent follows the state, after the command name in parentheses
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(name))
+    tree = [pid]
+    for process in tree:
+        tree.extend(children.get(process, []))
+    return tree
+
+
+def peak_rss_kb(pid):
+    # Peak resident memory of a running process in kilobytes, 0 once it has exited
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def write_pairs(reads, r1_file, r2_file, length=READ_LENGTH):
+    # Cuts each merged read into the read pair it would have been sequenced as
+    with open_binary(r1_file, "wb") as r1, open_binary(r2_file, "wb") as r2:
+        for header, seq, quality in reads:
+            r1.write(format_fastq(header, seq[:length], quality[:length]))
+            r2.write(format_fastq(header, reverse_complement(seq[-length:]), quality[-length:][::-1]))
+
+
+def stages(directory, threads, tools):
+    """
+    Commands of each stage for a sample simulated to directory/reads.fq, and to directory/R1.fq and directory/R2.fq if
+    bbduk or bbmerge are benchmarked, as (name, command) pairs run in order
+    :param tools: External tools found on the PATH
+    """
+    script = lambda name: os.path.join(PIPELINE_FILES, name)
+    path = lambda name: os.path.join(directory, name)
+    reads = path("reads.fq")
+    consensus = path("consensus")
+    if "bbduk.sh" in tools:
+        yield "bbduk", ["bbduk.sh", "threads={}".format(threads), "in1=" + path("R1.fq"), "in2=" + path("R2.fq"),
+                        "out1=" + path("trimmed_R1.fq"), "out2=" + path("trimmed_R2.fq"), "ref=" + ADAPTERS,
+                        "qtrim=rl", "trimq=10", "ktrim=r", "k=23", "mink=11", "hdist=1", "tpe", "tbo"]
+    if "bbmerge.sh" in tools:
+        # Merges the trimmed pairs if bbduk ran, the simulated pairs otherwise
+        prefix = "trimmed_" if "bbduk.sh" in tools else ""
+        yield "bbmerge", ["bbmerge.sh", "threads={}".format(threads), "in=" + path(prefix + "R1.fq"),
+                          "in2=" + path(prefix + "R2.fq"), "outm=" + path("merged.fq"),
+                          "outu=" + path("unmerged.fq")]
+    yield "trim_primers", [sys.executable, script("trim_primers.py"), "-f", reads, "-p", PRIMERS,
+                           "-o", path("sliced.fq"), "--threads", str(threads)]
+    if "vsearch" in tools:
+        yield "vsearch", ["vsearch", "--derep_fulllength", path("sliced.fq"), "--sizein", "--fasta_width", "0",
+                          "--sizeout", "--output", path("vsearch.fas")]
+    yield "trim_primers --derep", [sys.executable, script("trim_primers.py"), "-f", reads, "-p", PRIMERS,
+                                   "-d", os.path.join(directory, "derep.fas"), "--threads", str(threads)]
+    yield "evaluate_vsearch", [sys.executable, script("evaluate_vsearch.py"), "-i",
+                               os.path.join(directory, "derep.fas"), "-o", os.path.join(consensus, "S0")]
+    yield "evaluate_consensus", [sys.executable, script("evaluate_consensus.py"), "-d", consensus]
+
+
+def copy_plate(consensus, plate):
+    # Copies the evaluated sample into plate sample directories for evaluate_consensus to summarise
+    source = os.path.join(consensus, "S0")
+    for index in range(1, plate):
+        sample = "S{}".format(index)
+        os.makedirs(os.path.join(consensus, sample), exist_ok=True)
+        for name in os.listdir(source):
+            shutil.copy(os.path.join(source, name), os.path.join(consensus, sample, name.replace("S0", sample, 1)))
+
+
+def benchmark(depths, plate=96, threads=1, contamination=0.05, seed=1):
+    """
+    Prints the wall time, throughput and peak memory of every stage at every depth. evaluate_consensus summarises a
+    plate of samples regardless of their depth, so its throughput is in samples per second. External tools missing
+    from the PATH are listed as excluded first.
+    """
+    amplicon = load_amplicon()
+    tools = [tool for tool in TOOLS if shutil.which(tool)]
+    excluded = [tool for tool in TOOLS if tool not in tools]
+    if excluded:
+        print("Excluded, not on the PATH: {}".format(", ".join(excluded)))
+    print("{:<22} {:>9} {:>10} {:>14} {:>10} {:>10}".format("stage", "reads", "wall s", "rate", "unit", "peak MB"))
+    for depth in depths:
+        with tempfile.TemporaryDirectory() as directory:
+            write_reads(simulate_reads(amplicon, depth, contamination=contamination, seed=seed),
+                        os.path.join(directory, "reads.fq"))
+            if "bbduk.sh" in tools or "bbmerge.sh" in tools:
+                write_pairs(simulate_reads(amplicon, depth, contamination=contamination, seed=seed),
+                            os.path.join(directory, "R1.fq"), os.path.join(directory, "R2.fq"))
+            os.makedirs(os.path.join(directory, "consensus", "S0"))
+            # evaluate_consensus writes its summary to the working directory
+            working_directory = os.getcwd()
+            os.chdir(directory)
+            try:
+                for name, command in stages(directory, threads, tools):
+                    items, unit = depth, "reads/s"
+                    if name == "evaluate_consensus":
+                        copy_plate(os.path.join(directory, "consensus"), plate)
+                        items, unit = plate, "samples/s"
+                    elapsed, peak = run_stage(command)
+                    print("{:<22} {:>9} {:>10.3f} {:>14.0f} {:>10} {:>10}".format(
+                        name, depth, elapsed, items / elapsed, unit, "{:.1f}".format(peak) if peak else "-"))
+            finally:
+                os.chdir(working_directory)
+
+
+if __name__ == "__main__":
+    main()
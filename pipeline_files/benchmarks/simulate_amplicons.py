@@ -0,0 +1,201 @@
+"""
+Simulates merged reads of the dual fragment Diptera CO1 amplicon for testing and benchmarking the read processing
+scripts. The amplicon is cut from pipeline_files/co1.fasta between the primers of diptera_primers.fasta, and reads are
+built as trim_primers.py expects them: fragment A reads are a short spacer, the forward primer, the first 430 bases of
+the contig and the reverse complemented reverse primer, fragment B reads are the forward primer, the last 415 bases of
+the contig and the reverse complemented reverse primer. Depth, substitution rate, the number of oligos of each
+degenerate primer, contaminant haplotypes and unusable reads are configurable.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from seq_io import IUPAC_CODES, format_fastq, open_binary, read_fasta
+
+PIPELINE_FILES = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REFERENCE = os.path.join(PIPELINE_FILES, "co1.fasta")
+PRIMERS = os.path.join(PIPELINE_FILES, "diptera_primers.fasta")
+
+# Geometry of the contig evaluate_vsearch merges, fragment A's tail overlaps fragment B by 199 bases
+CONTIG_LENGTH = 646
+FRAGMENT_A_LENGTH = 430
+FRAGMENT_B_LENGTH = 415
+
+# Bases of the forward primer's 3' end used to place it on the reference
+PRIMER_ANCHOR = 14
+
+# Fragment A reads start with a spacer of up to this many random bases before the forward primer
+MAX_SPACER = 4
+
+# Length of fragment A reads that stop short of the reverse primer
+SHORT_READ_LENGTH = 200
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+# The three bases each base can be substituted with
+SUBSTITUTES = np.zeros((256, 3), dtype=np.uint8)
+SUBSTITUTES[:] = np.frombuffer(b"CGT", dtype=np.uint8)
+for base in b"ACGT":
+    SUBSTITUTES[base] = [other for other in b"ACGT" if other != base]
+
+COMPLEMENT = bytes.maketrans(b"ACGTRYSWKMBDHVN", b"TGCAYRSWMKVHDBN")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates merged reads of the Diptera CO1 amplicon')
+    parser.add_argument('-n', type=int,
+                        help='Number of reads', default=10000)
+    parser.add_argument('-o', type=str,
+                        help='Output fastq, .gz or .zst to compress, stdout if omitted', default="-")
+    parser.add_argument('-r', type=str,
+                        help='CO1 reference fasta', default=REFERENCE)
+    parser.add_argument('-p', type=str,
+                        help='Primer File in .fasta format', default=PRIMERS)
+    parser.add_argument('-e', '--error-rate', type=float,
+                        help='Substitutions per base', default=0.002)
+    parser.add_argument('-v', '--variants', type=int,
+                        help='Oligos drawn from each degenerate primer, 0 for a new oligo every read', default=0)
+    parser.add_argument('-c', '--contamination', type=float,
+                        help='Fraction of reads from contaminant haplotypes', default=0.0)
+    parser.add_argument('--haplotypes', type=int,
+                        help='Number of contaminant haplotypes', default=1)
+    parser.add_argument('--divergence', type=float,
+                        help='Substitutions per base between the contig and each contaminant haplotype', default=0.05)
+    parser.add_argument('--unusable', type=float,
+                        help='Fraction of reads too short or lacking primers', default=0.1)
+    parser.add_argument('--seed', type=int,
+                        help='Random seed', default=1)
+    args = parser.parse_args()
+
+    amplicon = load_amplicon(args.r, args.p)
+    reads = simulate_reads(amplicon, args.n, args.error_rate, args.variants, args.contamination, args.haplotypes,
+                           args.divergence, args.unusable, args.seed)
+    write_reads(reads, args.o)
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def load_amplicon(reference_file=REFERENCE, primer_file=PRIMERS):
+    """
+    Cuts the contig out of the reference, starting after the 3' end of the fragment A forward primer.
+    :return: Dictionary of the contig and the four primers as bytes, in the order of the primer file
+    """
+    reference = next(read_fasta(reference_file))[1].upper()
+    primers = [seq.upper() for _, seq in read_fasta(primer_file)]
+    if len(primers) != 4:
+        raise ValueError("Expected the 4 primers of fragments A and B in {}".format(primer_file))
+    anchor = primers[0][-PRIMER_ANCHOR:]
+    position = reference.find(anchor)
+    if position < 0:
+        raise ValueError("Fragment A forward primer not found in {}".format(reference_file))
+    start = position + len(anchor)
+    contig = reference[start:start + CONTIG_LENGTH]
+    if len(contig) != CONTIG_LENGTH:
+        raise ValueError("Reference is shorter than the {} bp contig".format(CONTIG_LENGTH))
+    return {"contig": contig, "primers": primers}
+
+
+def oligo_sampler(primer, variants, rng):
+    """
+    Returns a function drawing an oligo of a degenerate primer. With variants > 0 the oligos are drawn from a fixed
+    set of that many, as a primer synthesis batch would hold, otherwise every draw is independent.
+    """
+    options = [IUPAC_CODES[chr(base)].encode() for base in primer]
+    if all(len(bases) == 1 for bases in options):
+        return lambda: primer
+    # Bases of each position padded to 4 columns, drawn from the first count of them
+    table = np.array([np.frombuffer(bases.ljust(4, bases[:1]), dtype=np.uint8) for bases in options])
+    counts = np.array([len(bases) for bases in options])
+    rows = np.arange(len(options))
+
+    def draw():
+        return table[rows, (rng.random(len(options)) * counts).astype(np.int64)].tobytes()
+
+    if variants > 0:
+        pool = [draw() for _ in range(variants)]
+        return lambda: pool[rng.integers(len(pool))]
+    return draw
+
+
+def mutate(seq, rate, rng):
+    # Substitutes each base with a different random base at the given rate
+    count = rng.binomial(len(seq), rate) if rate > 0 else 0
+    if not count:
+        return seq
+    read = np.frombuffer(seq, dtype=np.uint8).copy()
+    positions = rng.integers(0, len(read), count)
+    read[positions] = SUBSTITUTES[read[positions], rng.integers(0, 3, count)]
+    return read.tobytes()
+
+
+def simulate_reads(amplicon, depth, error_rate=0.002, variants=0, contamination=0.0, haplotypes=1, divergence=0.05,
+                   unusable=0.1, seed=1):
+    """
+    Generator of (header, sequence, quality) byte strings of simulated merged reads. Usable reads are split evenly
+    between fragments A and B, and between the contig and the contaminant haplotypes by the contamination fraction.
+    Unusable reads are split evenly between fragment A reads cut short and random sequence without primers. Headers
+    record what each read was simulated as.
+    :param amplicon: Dictionary from load_amplicon
+    :param depth: Number of reads
+    :param error_rate: Substitutions per base of every read
+    :param variants: Oligos drawn from each degenerate primer, 0 for a new oligo every read
+    :param contamination: Fraction of usable reads from contaminant haplotypes
+    :param haplotypes: Number of contaminant haplotypes
+    :param divergence: Substitutions per base between the contig and each contaminant haplotype
+    :param unusable: Fraction of reads too short or lacking primers
+    :param seed: Random seed
+    """
+    rng = np.random.default_rng(seed)
+    contig = amplicon["contig"]
+    forward_a, reverse_a, forward_b, reverse_b = [oligo_sampler(primer, variants, rng)
+                                                   for primer in amplicon["primers"]]
+    templates = [contig] + [mutate(contig, divergence, rng) for _ in range(haplotypes if contamination else 0)]
+
+    kinds = rng.random(depth)
+    for index in range(depth):
+        draw = kinds[index]
+        if draw < unusable / 2:
+            kind = "short"
+            read = b"".join((BASES[rng.integers(0, 4, rng.integers(1, MAX_SPACER + 1))].tobytes(), forward_a(),
+                             contig[:SHORT_READ_LENGTH]))
+        elif draw < unusable:
+            kind = "primerless"
+            read = BASES[rng.integers(0, 4, FRAGMENT_A_LENGTH)].tobytes()
+        else:
+            usable = (draw - unusable) / (1 - unusable)
+            haplotype = 0
+            if usable < contamination:
+                haplotype = 1 + int(rng.integers(len(templates) - 1))
+            template = templates[haplotype]
+            if rng.random() < 0.5:
+                kind = "fragment_a"
+                read = b"".join((BASES[rng.integers(0, 4, rng.integers(1, MAX_SPACER + 1))].tobytes(), forward_a(),
+                                 template[:FRAGMENT_A_LENGTH], reverse_complement(reverse_a())))
+            else:
+                kind = "fragment_b"
+                read = b"".join((forward_b(), template[CONTIG_LENGTH - FRAGMENT_B_LENGTH:],
+                                 reverse_complement(reverse_b())))
+            if haplotype:
+                kind += " haplotype={}".format(haplotype)
+        read = mutate(read, error_rate, rng)
+        # Random Phred 20 to 40 qualities
+        quality = rng.integers(53, 74, len(read), dtype=np.uint8).tobytes()
+        yield b"sim%d %s" % (index, kind.encode()), read, quality
+
+
+def write_reads(reads, output_file):
+    with open_binary(output_file, "wb") as f:
+        for read in reads:
+            f.write(format_fastq(*read))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,16 @@ import asyncio
 import argparse
 import csv
 import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Dict, Optional
-from urllib.parse import urlencode
+from urllib.parse import quote, urlencode
 
 from Bio import SeqIO
 import dataset
 import requests
+from requests.adapters import HTTPAdapter
 
 from engine import generate_output_content, parse_id_engine_xml, HEADERS
 
@@ -15,6 +19,24 @@ from engine import generate_output_content, parse_id_engine_xml, HEADERS
 DATABASE_URL = "sqlite:///bold.sqlite"
 DB = dataset.connect(DATABASE_URL)
 
+BOLD_URL = "http://boldsystems.org/index.php"
+REQUEST_HEADERS = {'User-Agent': 'bold_retriever'}
+
+# Requests in flight at once, sequences identified at once and requests started per second, 0 for no limit
+MAX_REQUESTS = 8
+MAX_RECORDS = 16
+RATE_LIMIT = 10.0
+
+# Failed requests are retried after BACKOFF seconds, doubled on every attempt
+RETRIES = 3
+BACKOFF = 1.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+TIMEOUT = 120
+
+# Specimen IDs whose BINs are requested together, and seconds a partial batch waits for more IDs
+BIN_BATCH = 100
+BIN_LINGER = 0.2
+
 
 def create_output_file(input_filename: str) -> str:
     """Containing only column headers of the CSV file."""
@@ -25,67 +47,243 @@ def create_output_file(input_filename: str) -> str:
     return output_filename
 
 
-async def execute_one_record(db, output_filename, seq_record):
+def new_client(base_url=BOLD_URL, max_requests=MAX_REQUESTS, rate_limit=RATE_LIMIT, retries=RETRIES,
+               backoff=BACKOFF, timeout=TIMEOUT, bin_batch=BIN_BATCH, bin_linger=BIN_LINGER):
+    """
+    State shared by every request: a session whose pool of keep-alive connections is shared by the worker threads
+    sending requests, a semaphore bounding the requests in flight, the time the next request may start, the
+    lookups already made and the specimen IDs waiting for a BIN request. Must be created with the event loop running.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_requests)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(REQUEST_HEADERS)
+    return {
+        "session": session,
+        "base_url": base_url.rstrip("/"),
+        "executor": ThreadPoolExecutor(max_requests),
+        "semaphore": asyncio.Semaphore(max_requests),
+        "interval": 1.0 / rate_limit if rate_limit > 0 else 0.0,
+        "next_request": 0.0,
+        "retries": retries,
+        "backoff": backoff,
+        "timeout": timeout,
+        "lookups": {},
+        "bin_batch": max(1, bin_batch),
+        "bin_linger": bin_linger,
+        "pending_bins": {},
+        "bin_timer": None,
+    }
+
+
+def close_client(client):
+    if client["bin_timer"] is not None:
+        client["bin_timer"].cancel()
+    client["executor"].shutdown()
+    client["session"].close()
+
+
+async def throttle(client):
+    """Waits for the next free slot of the rate limit"""
+    loop = asyncio.get_event_loop()
+    now = loop.time()
+    start = max(now, client["next_request"])
+    client["next_request"] = start + client["interval"]
+    if start > now:
+        await asyncio.sleep(start - now)
+
+
+async def fetch(client, url):
+    """
+    Sends a GET request from a worker thread, so the event loop carries on with other records while it is in
+    flight. Connection errors and busy or failing servers are retried with exponential backoff, and the response of
+    the last attempt is returned.
+    """
+    loop = asyncio.get_event_loop()
+    get = partial(client["session"].get, url, timeout=client["timeout"])
+    for attempt in range(client["retries"] + 1):
+        error = None
+        async with client["semaphore"]:
+            await throttle(client)
+            try:
+                response = await loop.run_in_executor(client["executor"], get)
+            except requests.RequestException as request_error:
+                error = request_error
+        if error is None and response.status_code not in RETRY_STATUS:
+            return response
+        if attempt < client["retries"]:
+            await asyncio.sleep(client["backoff"] * 2 ** attempt)
+    if error is not None:
+        raise error
+    return response
+
+
+def lookup(client, key, factory):
+    """Task of a lookup, shared by every record asking for the same key so each is only requested once per run"""
+    task = client["lookups"].get(key)
+    if task is None:
+        task = client["lookups"][key] = asyncio.ensure_future(factory())
+        task.add_done_callback(partial(forget_failed, client["lookups"], key))
+    return task
+
+
+def forget_failed(lookups, key, task):
+    if task.cancelled() or task.exception() is not None:
+        lookups.pop(key, None)
+
+
+async def execute_one_record(db, output_filename, seq_record, client):
     print(f"* Reading seq {seq_record.name}")
-    response = id_engine(seq_record, db, output_filename)
+    response = await fetch(client, id_engine_url(seq_record, db, client["base_url"]))
     seq_record_identifications = parse_id_engine_xml(response.text)
+
+    # BINs are queued first so their batch fills up with other records' IDs while the taxonomy is looked up
+    bins = request_bins(client, [identification.get("ID") for identification in seq_record_identifications])
+
+    # Matches often share a taxon, so each taxon is looked up once
+    taxa = set(identification.get("taxonomicidentification") for identification in seq_record_identifications)
+    taxa.discard(None)
+    taxa = sorted(taxa)
+    taxonomies = await asyncio.gather(*[lookup(client, ("taxonomy", taxon), partial(fetch_taxonomy, client, taxon))
+                                        for taxon in taxa])
+    taxonomies = dict(zip(taxa, taxonomies))
+    bins = await asyncio.gather(*bins)
+
     # add our seq id to the list of identifications
-    for seq_record_identification in seq_record_identifications:
+    for seq_record_identification, bin in zip(seq_record_identifications, bins):
         seq_record_identification["OtuID"] = seq_record.id
-        taxonomy = get_taxonomy(seq_record_identification)
-        try:
-            bin = get_bin([seq_record_identification["ID"]])
-        except KeyError:
-            bin = ""
         seq_record_identification["BIN"] = bin
-        seq_record_identification.update(taxonomy)
+        taxonomy = taxonomies.get(seq_record_identification.get("taxonomicidentification"))
+        if taxonomy:
+            seq_record_identification.update(taxonomy)
         seq_record_identification["seq_record"] = seq_record
     generate_output_content(seq_record_identifications, output_filename, seq_record)
 
 
-def id_engine(seq_record, db, output_filename):
-    """Send a COI sequence to BOLD and retrieve its identification"""
-    print(f"* Processing sequence for {seq_record.id}")
+async def fetch_taxonomy(client, taxon):
+    """Tax ID and higher level taxonomy of a taxon, from the database where it has been seen before"""
+    tax_id = get_tax_id_from_db({"taxonomicidentification": taxon})
+    if not tax_id:
+        response = await fetch(client, tax_id_url(taxon, client["base_url"]))
+        tax_id = parse_tax_id(response.json())
+        if tax_id:
+            save_tax_id(taxon, tax_id)
+    if not tax_id:
+        return None
+
+    taxonomy = get_taxonomy_from_db(tax_id)
+    if not taxonomy:
+        response = await fetch(client, taxonomy_url(tax_id, client["base_url"]))
+        taxonomy = parse_taxonomy(response.json(), tax_id)
+        save_taxonomy(taxonomy)
+    return taxonomy
 
-    domain = "http://boldsystems.org/index.php/Ids_xml"
+
+def request_bins(client, ids):
+    """
+    Futures of the BINs of specimen IDs. IDs not seen before in the run are queued and sent in bulk requests of up to
+    bin_batch IDs, or once the oldest has waited bin_linger seconds.
+    """
+    loop = asyncio.get_event_loop()
+    futures = []
+    for id in ids:
+        if not id:
+            future = loop.create_future()
+            future.set_result("")
+            futures.append(future)
+            continue
+        future = client["lookups"].get(("bin", id))
+        if future is None:
+            future = client["lookups"][("bin", id)] = loop.create_future()
+            client["pending_bins"][id] = future
+            if len(client["pending_bins"]) >= client["bin_batch"]:
+                flush_bins(client)
+            elif client["bin_timer"] is None:
+                client["bin_timer"] = loop.call_later(client["bin_linger"], flush_bins, client)
+        futures.append(future)
+    return futures
+
+
+def flush_bins(client):
+    """Sends the queued specimen IDs in one request"""
+    if client["bin_timer"] is not None:
+        client["bin_timer"].cancel()
+        client["bin_timer"] = None
+    pending = client["pending_bins"]
+    client["pending_bins"] = {}
+    if pending:
+        asyncio.ensure_future(fetch_bins(client, pending))
+
+
+async def fetch_bins(client, futures):
+    """Resolves the futures of a batch of specimen IDs from one request. A failed batch fails each of its IDs"""
+    try:
+        response = await fetch(client, bin_url(list(futures), client["base_url"]))
+        bins = parse_bins(response)
+    except Exception as error:
+        for id, future in futures.items():
+            client["lookups"].pop(("bin", id), None)
+            future.set_exception(error)
+        return
+    for id, future in futures.items():
+        future.set_result(bins.get(id))
+
+
+def id_engine_url(seq_record, db, base_url=BOLD_URL):
     payload = {'db': db, 'sequence': str(seq_record.seq)}
-    url = domain + '?' + urlencode(payload)
+    return base_url + "/Ids_xml?" + urlencode(payload)
+
+
+def tax_id_url(taxon, base_url=BOLD_URL):
+    return base_url + "/API_Tax/TaxonSearch?taxName=" + quote(taxon)
+
+
+def taxonomy_url(tax_id, base_url=BOLD_URL):
+    return base_url + f"/API_Tax/TaxonData?taxId={tax_id}&dataTypes=basic&includeTree=true"
+
+
+def bin_url(ids, base_url=BOLD_URL):
+    return base_url + "/API_Public/specimen?ids=" + "|".join(ids) + "&format=json"
+
+
+def id_engine(seq_record, db, output_filename, session=requests, base_url=BOLD_URL):
+    """Send a COI sequence to BOLD and retrieve its identification"""
+    print(f"* Processing sequence for {seq_record.id}")
 
-    res = requests.get(url, headers={'User-Agent': 'bold_retriever'})
+    url = id_engine_url(seq_record, db, base_url)
+    res = session.get(url, headers=REQUEST_HEADERS)
     return res
 
 
-def get_taxonomy(seq_record: Dict[str, str]) -> Optional[Dict[str, str]]:
-    tax_id = get_tax_id(seq_record)
+def get_taxonomy(seq_record: Dict[str, str], session=requests, base_url=BOLD_URL) -> Optional[Dict[str, str]]:
+    tax_id = get_tax_id(seq_record, session, base_url)
     if tax_id:
-        taxonomy = get_higher_level_taxonomy(tax_id)
+        taxonomy = get_higher_level_taxonomy(tax_id, session, base_url)
         return taxonomy
 
 
-def get_tax_id(seq_record: Dict[str, str]):
+def get_tax_id(seq_record: Dict[str, str], session=requests, base_url=BOLD_URL):
     tax_id = get_tax_id_from_db(seq_record)
     if tax_id:
         return tax_id
 
-    domain = "http://boldsystems.org/index.php/API_Tax/TaxonSearch?taxName="
-    url = domain + seq_record["taxonomicidentification"]
-    res = requests.get(url, headers={'User-Agent': 'bold_retriever'})
-    response_json = res.json()
-    try:
-        tax_id = response_json["top_matched_names"][0]["taxid"]
-    except (KeyError, IndexError):
-        tax_id = None
+    url = tax_id_url(seq_record["taxonomicidentification"], base_url)
+    res = session.get(url, headers=REQUEST_HEADERS)
+    tax_id = parse_tax_id(res.json())
 
     if tax_id:
-        table = DB["tax_ids"]
-        data = {
-            "taxon": seq_record["taxonomicidentification"],
-            "tax_id": tax_id,
-        }
-        table.insert(data)
+        save_tax_id(seq_record["taxonomicidentification"], tax_id)
     return tax_id
 
 
+def parse_tax_id(response_json):
+    try:
+        return response_json["top_matched_names"][0]["taxid"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
 def get_tax_id_from_db(seq_record: Dict[str, str]) -> Optional[str]:
     table = DB["tax_ids"]
     element = table.find_one(taxon=seq_record["taxonomicidentification"])
@@ -93,17 +291,36 @@ def get_tax_id_from_db(seq_record: Dict[str, str]) -> Optional[str]:
         return element["tax_id"]
 
 
-def get_higher_level_taxonomy(tax_id):
+def save_tax_id(taxon, tax_id):
+    table = DB["tax_ids"]
+    data = {
+        "taxon": taxon,
+        "tax_id": tax_id,
+    }
+    table.insert(data)
+
+
+def get_higher_level_taxonomy(tax_id, session=requests, base_url=BOLD_URL):
+    taxonomy = get_taxonomy_from_db(tax_id)
+    if taxonomy:
+        return taxonomy
+
+    url = taxonomy_url(tax_id, base_url)
+    res = session.get(url, headers=REQUEST_HEADERS)
+    taxonomy = parse_taxonomy(res.json(), tax_id)
+    save_taxonomy(taxonomy)
+    return taxonomy
+
+
+def get_taxonomy_from_db(tax_id):
     table = DB["taxonomy"]
     element = table.find_one(tax_id=tax_id)
     if element:
         del element["id"]
         return element
 
-    url = f"http://boldsystems.org/index.php/API_Tax/TaxonData?taxId={tax_id}" \
-          "&dataTypes=basic&includeTree=true"
-    res = requests.get(url, headers={'User-Agent': 'bold_retriever'})
-    response_json = res.json()
+
+def parse_taxonomy(response_json, tax_id):
     taxonomy = dict()
 
     for id in response_json.keys():
@@ -113,15 +330,62 @@ def get_higher_level_taxonomy(tax_id):
         taxonomy[key] = value
 
     taxonomy["tax_id"] = tax_id
-    table.insert(taxonomy)
     return taxonomy
 
 
-def get_bin(ids):
-    ids = "|".join(ids)
-    url = f"http://boldsystems.org/index.php/API_Public/specimen?ids={ids}&format=json"
-    res = requests.get(url, headers={'User-Agent': 'bold_retriever'})
+def save_taxonomy(taxonomy):
+    table = DB["taxonomy"]
+    table.insert(dict(taxonomy))
+
+
+def get_bin(ids, session=requests, base_url=BOLD_URL):
+    url = bin_url(ids, base_url)
+    res = session.get(url, headers=REQUEST_HEADERS)
+    return parse_bin(res)
+
+
+def get_bins(ids, session=requests, base_url=BOLD_URL, batch_size=BIN_BATCH) -> Dict[str, Optional[str]]:
+    """
+    BIN of every specimen ID, requested batch_size IDs at a time. IDs BOLD has no record or BIN of map to None, a
+    failed request raises as parse_bins does
+    """
+    ids = list(dict.fromkeys(ids))
+    bins = dict.fromkeys(ids)
+    for start in range(0, len(ids), batch_size):
+        res = session.get(bin_url(ids[start:start + batch_size], base_url), headers=REQUEST_HEADERS)
+        bins.update((id, bin) for id, bin in parse_bins(res).items() if id in bins)
+    return bins
+
+
+def parse_bins(res) -> Dict[str, Optional[str]]:
+    """
+    BIN of every record of a specimen response, by its process ID. An empty response has no records.
+    :raises requests.HTTPError: If the request failed
+    :raises ValueError: If the response isn't a specimen response, so a failed lookup isn't taken for IDs without BINs
+    """
+    res.raise_for_status()
+    if not res.content.strip():
+        return {}
+    records = res.json()
+    if not records:
+        return {}
+    try:
+        elements = records["bold_records"]["records"]
+    except (KeyError, TypeError):
+        raise ValueError("Unexpected specimen response from {}".format(res.url))
+
+    if isinstance(elements, dict):
+        elements = elements.items()
+    else:
+        elements = [(element.get("processid"), element) for element in elements]
+
+    bins = {}
+    for key, element in elements:
+        bins[element.get("processid", key)] = element.get("bin_uri")
+    return bins
 
+
+def parse_bin(res):
     records = None
     elements = None
     bin = None
@@ -148,31 +412,93 @@ def get_bin(ids):
     return bin
 
 
-async def main():
-    if __name__ == "__main__":
-        parser = argparse.ArgumentParser(description="bold_retriever")
-        parser.add_argument('-f', '--filename', type=str, help='Fasta filename', required=True)
-        parser.add_argument(
-            '-db',
-            '--database',
-            choices=['COX1_SPECIES', 'COX1', 'COX1_SPECIES_PUBLIC', 'COX1_L640bp'],
-            help='Choose a BOLD database. Enter one option.',
-            required=True,
-        )
-        args = parser.parse_args()
-
-        # Send seqs to BOLD Systems API and retrieve results
-        fasta_file = args.filename
-        db = args.database
-        output_filename = create_output_file(fasta_file)
-        print(f"Reading sequences from {fasta_file}")
-
-        tasks = []
-        for seq_record in SeqIO.parse(fasta_file, "fasta"):
-            tasks.append(asyncio.ensure_future(execute_one_record(db, output_filename, seq_record)))
-        await asyncio.gather(*tasks)
-
-
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main())
-loop.close()
+async def record_worker(queue, db, output_filename, client):
+    """Identifies records from the queue until it is given None. A failed record is reported and skipped"""
+    failed = 0
+    while True:
+        seq_record = await queue.get()
+        if seq_record is None:
+            return failed
+        try:
+            await execute_one_record(db, output_filename, seq_record, client)
+        except Exception as error:
+            print(f"* Failed to identify {seq_record.id}: {error}")
+            failed += 1
+
+
+async def identify_records(records, db, output_filename, client, max_records=MAX_RECORDS):
+    """
+    Identifies records read from an iterator, max_records at a time. Records wait in a queue no longer than
+    max_records, so the next is only read once a worker is free to take it and large fastas are never held in memory.
+    Database lookups happen on the event loop thread, only requests are sent from worker threads.
+    :return: Number of records that failed
+    """
+    queue = asyncio.Queue(max_records)
+    workers = [asyncio.ensure_future(record_worker(queue, db, output_filename, client))
+               for _ in range(max_records)]
+    try:
+        for seq_record in records:
+            await queue.put(seq_record)
+        for _ in workers:
+            await queue.put(None)
+    except BaseException:
+        for worker in workers:
+            worker.cancel()
+        raise
+    failed = await asyncio.gather(*workers)
+    return sum(failed)
+
+
+async def identify_fasta(fasta_file, db, base_url=BOLD_URL, max_requests=MAX_REQUESTS, max_records=MAX_RECORDS,
+                         rate_limit=RATE_LIMIT, retries=RETRIES, backoff=BACKOFF, bin_batch=BIN_BATCH,
+                         bin_linger=BIN_LINGER):
+    output_filename = create_output_file(fasta_file)
+    print(f"Reading sequences from {fasta_file}")
+    client = new_client(base_url, max_requests, rate_limit, retries, backoff, bin_batch=bin_batch,
+                        bin_linger=bin_linger)
+    try:
+        return await identify_records(SeqIO.parse(fasta_file, "fasta"), db, output_filename, client, max_records)
+    finally:
+        close_client(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bold_retriever")
+    parser.add_argument('-f', '--filename', type=str, help='Fasta filename', required=True)
+    parser.add_argument(
+        '-db',
+        '--database',
+        choices=['COX1_SPECIES', 'COX1', 'COX1_SPECIES_PUBLIC', 'COX1_L640bp'],
+        help='Choose a BOLD database. Enter one option.',
+        required=True,
+    )
+    parser.add_argument('--url', type=str, help='Base URL of the BOLD API', default=BOLD_URL)
+    parser.add_argument('-n', '--max-requests', type=int, help='Requests in flight at once', default=MAX_REQUESTS)
+    parser.add_argument('-c', '--max-records', type=int, help='Sequences identified at once', default=MAX_RECORDS)
+    parser.add_argument('-r', '--rate-limit', type=float,
+                        help='Requests started per second, 0 for no limit', default=RATE_LIMIT)
+    parser.add_argument('--retries', type=int, help='Retries of a failed request', default=RETRIES)
+    parser.add_argument('--backoff', type=float,
+                        help='Seconds before the first retry, doubled on every retry', default=BACKOFF)
+    parser.add_argument('-b', '--bin-batch', type=int,
+                        help='Specimen IDs whose BINs are requested together', default=BIN_BATCH)
+    parser.add_argument('--bin-linger', type=float,
+                        help='Seconds a partial batch of specimen IDs waits for more', default=BIN_LINGER)
+    args = parser.parse_args()
+
+    # Send seqs to BOLD Systems API and retrieve results
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        failed = loop.run_until_complete(identify_fasta(
+            args.filename, args.database, args.url, args.max_requests, args.max_records, args.rate_limit,
+            args.retries, args.backoff, args.bin_batch, args.bin_linger))
+    finally:
+        loop.close()
+    if failed:
+        print(f"{failed} sequences could not be identified")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,24 @@
+import asyncio
+import csv
 import os
 import json
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
 
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
+import dataset
+import requests
 
-from bold_retriever import create_output_file, get_bin
+import bold_retriever
+from bold_retriever import create_output_file, get_bin, get_bins
 import engine
 
 
@@ -14,6 +26,64 @@ TEST_FILE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                               "Data")
 
 
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BoldHandler(BaseHTTPRequestHandler):
+    """Stands in for the BOLD API, answering every ID Engine query with tests/Data/id_engine.xml"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        with server.lock:
+            server.requests.append(self.path)
+            server.connections.add(self.client_address)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failing = server.failures > 0
+            server.failures -= 1
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+
+        if failing:
+            self.send_body(503, b"busy")
+        elif url.path.endswith("/Ids_xml"):
+            with open(os.path.join(TEST_FILE_PATH, "id_engine.xml"), "rb") as handle:
+                self.send_body(200, handle.read())
+        elif url.path.endswith("/API_Tax/TaxonSearch"):
+            taxon = query["taxName"][0]
+            self.send_json({"top_matched_names": [{"taxid": str(sum(taxon.encode()))}]})
+        elif url.path.endswith("/API_Tax/TaxonData"):
+            tax_id = query["taxId"][0]
+            self.send_json({"1": {"taxon": "Arthropoda", "tax_rank": "phylum"},
+                            tax_id: {"taxon": "Taxon " + tax_id, "tax_rank": "genus"}})
+        elif url.path.endswith("/API_Public/specimen") and server.bin_status != 200:
+            self.send_body(server.bin_status, b"error")
+        elif url.path.endswith("/API_Public/specimen"):
+            ids = query["ids"][0].split("|")
+            self.send_json({"bold_records": {"records": {id: {"processid": id, "bin_uri": "BOLD:" + id}
+                                                         for id in ids if not id.startswith("NOBIN")}}})
+        else:
+            self.send_body(404, b"")
+
+    def send_json(self, data):
+        self.send_body(200, json.dumps(data).encode())
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
 class TestBoldRetriever(unittest.TestCase):
 
     def setUp(self):
@@ -28,6 +98,14 @@ class TestBoldRetriever(unittest.TestCase):
             result = get_bin("some taxon id")
             self.assertEqual("BOLD:AAA3750", result)
 
+    @patch("bold_retriever.requests.get")
+    def test_get_bins(self, mock_get):
+        with open(os.path.join(TEST_FILE_PATH, "bin.json"), "r") as handle:
+            mock_get.return_value.json.return_value = json.load(handle)
+        result = get_bins(["SAMOS029-09", "SAMOS022-09"])
+        self.assertEqual({"SAMOS029-09": "BOLD:AAA3750", "SAMOS022-09": None}, result)
+        self.assertIn("ids=SAMOS029-09|SAMOS022-09&", mock_get.call_args[0][0])
+
     def test_create_output_file(self):
         result = create_output_file("my_fasta_file.fas")
         expected = "my_fasta_file.fas_output.csv"
@@ -63,3 +141,141 @@ class TestBoldRetriever(unittest.TestCase):
             if os.path.isfile(filename):
                 os.remove(filename)
 
+
+class TestConcurrentRetriever(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), BoldHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.failures = 0
+        self.server.delay = 0.0
+        self.server.bin_status = 200
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/index.php".format(self.server.server_port)
+
+        self.directory = tempfile.mkdtemp()
+        self.db = patch("bold_retriever.DB", dataset.connect("sqlite://"))
+        self.db.start()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def identify(self, fasta, **kwargs):
+        options = {"max_requests": 4, "rate_limit": 0, "backoff": 0.01}
+        options.update(kwargs)
+        return self.loop.run_until_complete(bold_retriever.identify_fasta(fasta, "COX1_SPECIES", self.url, **options))
+
+    def fetch_all(self, count, **kwargs):
+        async def fetch_all():
+            client = bold_retriever.new_client(self.url, **kwargs)
+            try:
+                return await asyncio.gather(*[bold_retriever.fetch(client, self.url + "/API_Public/specimen?ids=A")
+                                              for _ in range(count)])
+            finally:
+                bold_retriever.close_client(client)
+        return self.loop.run_until_complete(fetch_all())
+
+    def test_identify_fasta(self):
+        fasta = os.path.join(self.directory, "contigs.fasta")
+        with open(fasta, "w") as handle:
+            for i in range(5):
+                handle.write(">contig{}\nACGTACGT\n".format(i))
+
+        failed = self.identify(fasta)
+        self.assertEqual(0, failed)
+        with open(fasta + "_output.csv") as handle:
+            rows = list(csv.DictReader(handle))
+        self.assertEqual(5 * 101, len(rows))
+        self.assertEqual({"contig{}".format(i) for i in range(5)}, {row["OtuID"] for row in rows})
+        for row in rows:
+            self.assertEqual("BOLD:" + row["ID"], row["BIN"])
+            self.assertEqual("Arthropoda", row["phylum"])
+
+        # The five taxa of the matches are each looked up once, and remembered in the database
+        searches = [path for path in self.server.requests if "TaxonSearch" in path]
+        self.assertEqual(5, len(searches))
+        self.assertEqual(5, len(bold_retriever.DB["taxonomy"]))
+
+        # The 101 specimen IDs the records share are requested once, in batches
+        batches = [parse_qs(urlparse(path).query)["ids"][0].split("|") for path in self.server.requests
+                   if "specimen" in path]
+        self.assertEqual([100, 1], sorted((len(ids) for ids in batches), reverse=True))
+        self.assertEqual(101, len(set(id for ids in batches for id in ids)))
+
+    def test_bin_batch_size(self):
+        fasta = os.path.join(self.directory, "contigs.fasta")
+        with open(fasta, "w") as handle:
+            for i in range(3):
+                handle.write(">contig{}\nACGTACGT\n".format(i))
+
+        self.identify(fasta, bin_batch=30, bin_linger=0.5)
+        batches = [path for path in self.server.requests if "specimen" in path]
+        self.assertEqual(4, len(batches))
+
+    def test_get_bins(self):
+        ids = ["SAMOS029-09", "NOBIN1", "SAMOS022-09", "SAMOS029-09", "GBMIN1234-13"]
+        with requests.Session() as session:
+            result = get_bins(ids, session, self.url, batch_size=2)
+        self.assertEqual({"SAMOS029-09": "BOLD:SAMOS029-09", "NOBIN1": None, "SAMOS022-09": "BOLD:SAMOS022-09",
+                          "GBMIN1234-13": "BOLD:GBMIN1234-13"}, result)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_failed_bin_lookup(self):
+        # A BIN request that fails every retry fails its records, rather than giving them no BIN
+        self.server.bin_status = 500
+        with requests.Session() as session:
+            with self.assertRaises(requests.HTTPError):
+                get_bins(["SAMOS029-09"], session, self.url)
+
+        fasta = os.path.join(self.directory, "contigs.fasta")
+        with open(fasta, "w") as handle:
+            for i in range(2):
+                handle.write(">contig{}\nACGTACGT\n".format(i))
+        failed = self.identify(fasta, retries=1)
+        self.assertEqual(2, failed)
+        with open(fasta + "_output.csv") as handle:
+            self.assertEqual([], list(csv.DictReader(handle)))
+
+    def test_bounded_requests_and_connections(self):
+        self.server.delay = 0.02
+        responses = self.fetch_all(20, max_requests=3, rate_limit=0)
+        self.assertEqual([200] * 20, [response.status_code for response in responses])
+        self.assertLessEqual(self.server.max_in_flight, 3)
+        self.assertGreater(self.server.max_in_flight, 1)
+        # Keep-alive connections are reused rather than opened per request
+        self.assertLessEqual(len(self.server.connections), 3)
+
+    def test_rate_limit(self):
+        start = time.monotonic()
+        self.fetch_all(6, max_requests=6, rate_limit=50)
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50.0)
+
+    def test_retries(self):
+        self.server.failures = 2
+        responses = self.fetch_all(1, retries=3, backoff=0.01, rate_limit=0)
+        self.assertEqual(200, responses[0].status_code)
+        self.assertEqual(3, len(self.server.requests))
+
+        self.server.failures = 5
+        responses = self.fetch_all(1, retries=1, backoff=0.01, rate_limit=0)
+        self.assertEqual(503, responses[0].status_code)
+
+    def test_failed_record_is_skipped(self):
+        fasta = os.path.join(self.directory, "contigs.fasta")
+        with open(fasta, "w") as handle:
+            handle.write(">contig0\nACGT\n")
+        self.server.failures = 10
+        failed = self.identify(fasta, retries=1)
+        self.assertEqual(1, failed)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.db.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
@@ -7,7 +7,8 @@ License: MIT
 """
 
 import argparse
-from Bio import SeqIO
+
+from seq_io import open_binary, read_fasta, record_id, write_fasta
 
 
 def main():
@@ -43,15 +44,12 @@ def parse_output(file):
 
 def contig_extractor(no_hits, contigs):
     # Takes the contigs that did not return hits from Bold_Retriever and adds them to a multifasta
-    matching_seq = []
-    with open(contigs) as f:
-        for seq in SeqIO.parse(f, 'fasta'):
-            if seq.id in no_hits:
-                matching_seq.append(seq)
-
+    no_hits = set(no_hits)
     new_name = contigs.replace(".fasta", "_nohits.fasta")
-    with open(new_name, "w") as g:
-        SeqIO.write(matching_seq, g, "fasta")
+    with open_binary(new_name, "wb") as g:
+        for header, seq in read_fasta(contigs):
+            if record_id(header).decode() in no_hits:
+                write_fasta(g, header, seq)
 
 
 if __name__ == "__main__":
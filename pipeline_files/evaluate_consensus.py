@@ -4,12 +4,24 @@ Author: Jackson Eyres
 Copyright: Government of Canada
 License: MIT
 """
-from Bio import SeqIO
 import os
-import glob
 import argparse
+import fcntl
+import json
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from seq_io import read_fasta, write_fasta
+
+# Cached results of every sample, keyed by sample, so only samples whose files changed are read again
+INDEX_FILE = ".evaluate_index.json"
+LOCK_FILE = ".evaluate_index.lock"
+
+SUMMARY_OUTPUT = "Summary_Output.csv"
+CURATED_OUTPUT = "Curated_Barcodes.fasta"
+SUMMARY_HEADER = "Sample Name, Correct Length (T/F), Correct Alignment Identity, >40 Reads? (T/F), " \
+                 "Possible Contamination (T/F), CO1 Sequence\n"
 
 
 def main():
@@ -17,80 +29,210 @@ def main():
                                                  'generates a multi-fasta and csv with results')
     parser.add_argument('-d', type=str,
                         help='Consensus Parent Directory', required=True)
+    parser.add_argument('-s', type=str, nargs='+',
+                        help='Only re-evaluate these sample directories into the cached results, without writing the '
+                             'summary and curated barcodes')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of sample directories evaluated concurrently', default=1)
+    parser.add_argument('-c', '--cached', action='store_true',
+                        help='Rewrite the outputs from the cached results without checking the files of indexed '
+                             'samples, only evaluating samples missing from the index')
     args = parser.parse_args()
 
-    evaluate(args.d)
+    evaluate(args.d, args.s, args.workers, args.cached)
 
 
-def evaluate(input_directory):
+def evaluate(input_directory, samples=None, workers=1, cached=False):
     """
     Examines all the consensus files and merger files. Records if a sequence has the correct attributes for curation,
     length = 646, identity of alignment is 30.8%, no other fragments >10% of the total and atleast 40 reads total
     between both fragments. If all these conditions met, sequences are printed into a multi-fasta file.
-    """
-    consensus_directories = sorted(glob.glob(os.path.join(input_directory, "*")))
-
-    summary_lines = []
-    curated_fastas = []
-    for consensus_dir in consensus_directories:
-        files = sorted(glob.glob(os.path.join(consensus_dir, "*")))
-        sample = os.path.basename(consensus_dir)
-        if len(files) == 5:
-
-            fasta = files[0]
-            merger = files[1]
-            contamination = files[4]
-
-            with open(fasta) as f:
-                sequence = SeqIO.read(f, "fasta")
-                sequence.id = sample
-                sequence.description = ""
-
-            possible_contamination = False
-            with open(contamination) as g:
-                data = g.read()
-                if data:
-                    possible_contamination = True
-
-            correct_length = True
-            if len(sequence.seq) != 646:
-                correct_length = False
-
-            with open(merger) as h:
-                lines = h.readlines()
-                size_a = int(lines[15].rstrip().split("=")[1])
-                size_b = int(lines[16].rstrip().split("=")[1])
-                identity_line = str(lines[22].rstrip())
-
-            correct_identity = False
-            regex = r"\(([^)]+)\)"
-            match = re.search(regex, identity_line)
-            if match:
-                if match[0] == "(30.8%)":
-                    correct_identity = True
-
-            enough_reads = False
-            if size_a + size_b > 40:
-                enough_reads = True
-
-            if correct_length and enough_reads and correct_identity and not possible_contamination:
-                curated_fastas.append(sequence)
-
-            s = "{},{},{},{},{},{}\n".format(sample, correct_length, correct_identity,
-                                             enough_reads, possible_contamination, sequence.seq)
-            summary_lines.append(s)
 
+    Results are cached in an index in the consensus directory along with the modification time and size of the files
+    they came from, so a run only reads the samples that changed since the last. Unless samples is given,
+    Summary_Output.csv and Curated_Barcodes.fasta are then rewritten from the index. The index is locked while it is
+    updated, so samples can be added with the samples argument as they finish, each only updating the index, and a
+    final cached run writes the outputs once.
+
+    Sample directories are evaluated by a pool of worker threads, since the time goes into waiting on many small file
+    reads, which matters most on network filesystems. Output is always sorted by sample.
+    :param input_directory: Consensus Parent Directory
+    :param samples: Optional sample directories to update in the index alone, all sample directories are scanned and
+    the outputs written if None
+    :param workers: Number of sample directories evaluated concurrently
+    :param cached: Trust the cached result of every indexed sample rather than checking its files
+    """
+    with open(os.path.join(input_directory, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        start = time.perf_counter()
+        index_file = os.path.join(input_directory, INDEX_FILE)
+        index = load_index(index_file)
+
+        if samples:
+            consensus_directories = [os.path.join(input_directory, os.path.basename(os.path.normpath(sample)))
+                                     for sample in samples]
         else:
-            s = "{},{},{},{},{},{}\n".format(sample, "NA", "NA", "NA", "NA", "")
-            summary_lines.append(s)
+            consensus_directories = [entry.path for entry in os.scandir(input_directory) if entry.is_dir()]
+            # Forget samples that no longer exist
+            names = set(os.path.basename(consensus_dir) for consensus_dir in consensus_directories)
+            index = dict((sample, entry) for sample, entry in index.items() if sample in names)
+            if cached:
+                consensus_directories = [consensus_dir for consensus_dir in consensus_directories
+                                         if os.path.basename(consensus_dir) not in index]
+
+        consensus_directories.sort()
+        scanned = time.perf_counter()
+
+        def refresh(consensus_dir):
+            # Re-evaluates a sample only if its files changed since it was cached
+            entry = index.get(os.path.basename(consensus_dir))
+            signature = sample_signature(consensus_dir)
+            if entry is None or entry["signature"] != signature:
+                return {"path": consensus_dir, "signature": signature, "result": evaluate_sample(consensus_dir)}
+            return None
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            refreshed = list(executor.map(refresh, consensus_directories))
+        reread = 0
+        for consensus_dir, entry in zip(consensus_directories, refreshed):
+            if entry is not None:
+                index[os.path.basename(consensus_dir)] = entry
+                reread += 1
+        parsed = time.perf_counter()
+
+        write_atomic(index_file, lambda f: json.dump(index, f), "w")
+        # Samples folded in as they finish leave the outputs to the final run, rather than rewriting them every time
+        if not samples:
+            write_outputs([index[sample]["result"] for sample in sorted(index)])
+        written = time.perf_counter()
+
+        print("Evaluated {} of {} samples, {} unchanged".format(reread, len(index), len(index) - reread))
+        print("Scan {:.3f}s, parse {:.3f}s, write {:.3f}s with {} workers".format(scanned - start, parsed - scanned,
+                                                                                 written - parsed, workers))
+
+
+def load_index(index_file):
+    try:
+        with open(index_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def sample_signature(consensus_dir):
+    """
+    Modification time and size of the files a sample's result is read from, the structured result if present and
+    otherwise the fasta, merger and contamination files
+    """
+    signature = []
+    for path in sample_files(consensus_dir):
+        try:
+            stat = os.stat(path)
+            signature.append([os.path.basename(path), stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            signature.append([os.path.basename(path), None, None])
+    return signature
 
-    with open("Summary_Output.csv", "w") as f:
-        f.write("Sample Name, Correct Length (T/F), Correct Alignment Identity, >40 Reads? (T/F), Possible Contamination (T/F), CO1 Sequence\n")
-        for line in summary_lines:
-            f.write(line)
 
-    with open("Curated_Barcodes.fasta", "w") as f:
-        SeqIO.write(curated_fastas, f, "fasta")
+def sample_files(consensus_dir):
+    sample = os.path.basename(consensus_dir)
+    result_file = os.path.join(consensus_dir, sample + ".json")
+    if os.path.isfile(result_file):
+        return [result_file]
+    return [os.path.join(consensus_dir, sample + suffix) for suffix in (".fasta", ".merger", "_contamination.fasta")]
+
+
+def evaluate_sample(consensus_dir):
+    """
+    Evaluates a single sample from its structured result written by evaluate_vsearch, or from the merger report of
+    samples processed before those were written
+    :return: Dictionary of the summary columns and whether the sequence is curated
+    """
+    sample = os.path.basename(consensus_dir)
+    result_file = os.path.join(consensus_dir, sample + ".json")
+    if os.path.isfile(result_file):
+        try:
+            with open(result_file) as f:
+                record = json.load(f)
+        except ValueError:
+            record = {}
+        if record.get("status") != "merged":
+            return missing_result(sample)
+        alignment = record["alignment"]
+        size_a, size_b = [fragment["size"] for fragment in record["fragments"]]
+        identity = "({:.1f}%)".format(100.0 * alignment["identity"] / alignment["length"])
+        return curate(sample, record["sequence"], size_a, size_b, identity, len(record["contamination"]) > 0)
+
+    fasta, merger, contamination = sample_files(consensus_dir)
+    if not (os.path.isfile(fasta) and os.path.getsize(fasta) and os.path.isfile(merger) and
+            os.path.getsize(merger) and os.path.isfile(contamination)):
+        return missing_result(sample)
+
+    sequence = next(read_fasta(fasta))[1].decode()
+
+    possible_contamination = os.path.getsize(contamination) > 0
+
+    with open(merger) as h:
+        lines = h.readlines()
+        size_a = int(lines[15].rstrip().split("=")[1])
+        size_b = int(lines[16].rstrip().split("=")[1])
+        identity_line = str(lines[22].rstrip())
+
+    regex = r"\(([^)]+)\)"
+    match = re.search(regex, identity_line)
+    identity = match[0] if match else None
+    return curate(sample, sequence, size_a, size_b, identity, possible_contamination)
+
+
+def curate(sample, sequence, size_a, size_b, identity, possible_contamination):
+    correct_length = True
+    if len(sequence) != 646:
+        correct_length = False
+
+    correct_identity = False
+    if identity == "(30.8%)":
+        correct_identity = True
+
+    enough_reads = False
+    if size_a + size_b > 40:
+        enough_reads = True
+
+    return {"sample": sample, "correct_length": correct_length, "correct_identity": correct_identity,
+            "enough_reads": enough_reads, "possible_contamination": possible_contamination, "sequence": sequence,
+            "curated": correct_length and enough_reads and correct_identity and not possible_contamination}
+
+
+def missing_result(sample):
+    return {"sample": sample, "correct_length": "NA", "correct_identity": "NA", "enough_reads": "NA",
+            "possible_contamination": "NA", "sequence": "", "curated": False}
+
+
+def write_outputs(results):
+    """
+    Rewrites Summary_Output.csv and Curated_Barcodes.fasta from the results of every sample, sorted by sample
+    """
+    def write_summary(f):
+        f.write(SUMMARY_HEADER)
+        for result in results:
+            f.write("{},{},{},{},{},{}\n".format(result["sample"], result["correct_length"],
+                                                 result["correct_identity"], result["enough_reads"],
+                                                 result["possible_contamination"], result["sequence"]))
+
+    def write_curated(f):
+        for result in results:
+            if result["curated"]:
+                write_fasta(f, result["sample"].encode(), result["sequence"].encode())
+
+    write_atomic(SUMMARY_OUTPUT, write_summary, "w")
+    write_atomic(CURATED_OUTPUT, write_curated, "wb")
+
+
+def write_atomic(path, write, mode):
+    # Writes to a temporary file then moves it into place, so readers never see a partial file
+    temporary = path + ".tmp"
+    with open(temporary, mode) as f:
+        write(f)
+    os.replace(temporary, path)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,22 @@
 """
-Examines vsearch deprelicated reads and grabs the top two fragments and merges with emboss.
-Also reports if contamination likely by checking size of contamination file
-by looking at abundance of other reads
+Examines vsearch deprelicated reads and grabs the top two fragments and merges them, producing the same outputs as
+emboss merger.
+Also reports if contamination likely by looking at abundance of other reads, keeping only those whose k-mer profiles
+diverge from both fragments rather than sequencing error variants of them
 Author: Jackson Eyres
 Copyright: Government of Canada
 License: MIT
 """
-from Bio import SeqIO
 import os
 import argparse
-import subprocess
+import itertools
+import json
+import sys
+
+import numpy as np
+
+from merge_fragments import merge_records, write_report
+from seq_io import open_binary, read_fasta, record_id, write_fasta
 
 
 def main():
@@ -17,13 +24,85 @@ def main():
     parser.add_argument('-i', type=str,
                         help='Vsearch Fas', required=True)
     parser.add_argument('-o', type=str,
-                        help='Emboss Output Dir', required=True)
+                        help='Merger Output Dir', required=True)
+    parser.add_argument('-d', type=float,
+                        help='K-mer distance from both fragments above which an abundant sequence is reported as '
+                             'contamination', default=MAX_KMER_DISTANCE)
     args = parser.parse_args()
 
-    extract_contig(args.i, args.o)
-
-
-def extract_contig(input_file, output_directory):
+    extract_contig(args.i, args.o, args.d)
+
+
+# Sequences more abundant than this fraction of the top sequence are screened for contamination
+CONTAMINATION_ABUNDANCE = 0.1
+
+KMER_SIZE = 8
+
+# Fraction of a sequence's k-mers missing from the closest fragment. A single base error changes at most KMER_SIZE
+# of the roughly 420 k-mers of a fragment, a different haplotype changes far more
+MAX_KMER_DISTANCE = 0.1
+
+# 2 bit code of each base, 4 for anything else
+BASE_CODES = np.full(256, 4, dtype=np.int64)
+for code, base in enumerate(b"ACGT"):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+
+def abundance(header):
+    # Size annotation of a dereplicated sequence, e.g. ;size=120
+    return int(record_id(header).split(b"=")[1])
+
+
+def kmer_codes(seq, k=KMER_SIZE):
+    """
+    Distinct k-mers of a sequence as integers, skipping k-mers containing ambiguous bases
+    :param seq: Sequence as bytes
+    :param k:
+    :return: Sorted numpy array of k-mer codes
+    """
+    codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    windows = len(codes) - k + 1
+    if windows < 1:
+        return np.empty(0, dtype=np.int64)
+    kmers = np.zeros(windows, dtype=np.int64)
+    for offset in range(k):
+        kmers = kmers * 4 + (codes[offset:offset + windows] & 3)
+    ambiguous = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = ambiguous[k:k + windows] == ambiguous[:windows]
+    return np.unique(kmers[valid])
+
+
+def screen_contamination(candidates, fragments, max_distance=MAX_KMER_DISTANCE, k=KMER_SIZE):
+    """
+    Compares the k-mer profile of each candidate with the top two fragments. The distance is the fraction of the
+    candidate's k-mers absent from the closest fragment.
+    :param candidates: Iterable of (header, sequence) records
+    :param fragments: The top two (header, sequence) records
+    :param max_distance: Candidates further than this from both fragments are reported
+    :param k:
+    :return: List of (header, sequence, distance) of the candidates that are truly divergent
+    """
+    presence = np.zeros((len(fragments), 4 ** k), dtype=np.int32)
+    for row, (_, seq) in enumerate(fragments):
+        presence[row, kmer_codes(seq.upper(), k)] = 1
+
+    divergent = []
+    for header, seq in candidates:
+        kmers = kmer_codes(seq.upper(), k)
+        if len(kmers):
+            distance = 1.0 - presence[:, kmers].sum(axis=1).max() / float(len(kmers))
+        else:
+            distance = 1.0
+        if distance > max_distance:
+            divergent.append((header, seq, distance))
+        print("{} k-mer distance {:.4f} to closest fragment, {}".format(
+            record_id(header).decode(), distance, "possible contamination" if distance > max_distance else
+            "error variant"))
+    return divergent
+
+
+def extract_contig(input_file, output_directory, max_distance=MAX_KMER_DISTANCE):
 
     # Verify folders exist
     if os.path.isfile(input_file):
@@ -32,56 +111,66 @@ def extract_contig(input_file, output_directory):
         print("Missing either {}".format(input_file))
         return
 
-    seqs = []
-    for seq in SeqIO.parse(input_file, 'fasta'):
-        seqs.append(seq)
-
-    if len(seqs) > 1:
-        max_size = 0
-        actual_seqs = []
-        potential_contamination_seqs = []
-
-        index = 0
-        for seq in seqs:
-            index += 1
-            size = int(seq.id.split("=")[1])
+    # Dereplicated sequences are sorted by decreasing abundance, so only the head of the file is read
+    seqs = read_fasta(input_file)
+    actual_seqs = list(itertools.islice(seqs, 2))
 
-            if index == 1:
-                max_size = int(seq.id.split("=")[1])
-                actual_seqs.append(seq)
-                continue
+    file_prefix = os.path.split(output_directory)[1]
+    result_file = os.path.join(output_directory, file_prefix + ".json")
+    if len(actual_seqs) < 2:
+        write_result(result_file, {"sample": file_prefix, "status": "too_few_sequences",
+                                   "sequences": len(actual_seqs)})
 
-            if index == 2:
-                actual_seqs.append(seq)
-                continue
-
-            if size > float(max_size)*0.1:
-                potential_contamination_seqs.append(seq)
-
-        file_prefix = os.path.split(output_directory)[1]
-
-        a_sequence = os.path.join(output_directory, file_prefix + "_a.fasta")
-        with open(a_sequence, "w") as f:
-            SeqIO.write(actual_seqs[0], f, "fasta")
-
-        b_sequence = os.path.join(output_directory, file_prefix + "_b.fasta")
-        with open(b_sequence, "w") as f:
-            SeqIO.write(actual_seqs[1], f, "fasta")
+    else:
+        max_size = abundance(actual_seqs[0][0])
+        abundant_seqs = itertools.takewhile(lambda seq: abundance(seq[0]) > float(max_size)*CONTAMINATION_ABUNDANCE,
+                                            seqs)
+        potential_contamination_seqs = screen_contamination(abundant_seqs, actual_seqs, max_distance)
 
         output_file_1 = os.path.join(output_directory, file_prefix + ".merger")
         output_file_2 = os.path.join(output_directory, file_prefix + ".fasta")
 
         contamination_file = os.path.join(output_directory, file_prefix + "_contamination.fasta")
-        with open(contamination_file, "w") as f:
-            if len(potential_contamination_seqs) > 0:
-                SeqIO.write(potential_contamination_seqs, f, "fasta")
-
-        shell_call = "merger -asequence {} -bsequence {} -outfile {} -outseq {}".format(a_sequence,
-                                                                                        b_sequence,
-                                                                                        output_file_1,
-                                                                                        output_file_2)
-        print(shell_call)
-        subprocess.call(shell_call, shell=True)
+        with open_binary(contamination_file, "wb") as f:
+            for header, seq, distance in potential_contamination_seqs:
+                write_fasta(f, b"%s kmer_distance=%.4f" % (header, distance), seq)
+
+        # Banded overlap alignment of the two fragments in place of emboss merger
+        try:
+            result = merge_records(actual_seqs[0], actual_seqs[1])
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            write_result(result_file, {"sample": file_prefix, "status": "no_overlap"})
+            return
+        print("Merged {} and {}: length {}, identity {}/{}".format(result["a_name"], result["b_name"],
+                                                                 len(result["sequence"]), result["identity"],
+                                                                 result["length"]))
+        write_report(result, output_file_1)
+        with open_binary(output_file_2, "wb") as f:
+            write_fasta(f, result["a_name"].encode(), result["sequence"])
+
+        write_result(result_file, {
+            "sample": file_prefix,
+            "status": "merged",
+            "sequence": result["sequence"].decode(),
+            "length": len(result["sequence"]),
+            "fragments": [{"id": name, "size": abundance(name.encode())}
+                          for name in (result["a_name"], result["b_name"])],
+            "alignment": {"length": result["length"], "identity": result["identity"],
+                          "similarity": result["similarity"], "gaps": result["gaps"], "score": result["score"]},
+            "contamination": [{"id": record_id(header).decode(), "size": abundance(header),
+                               "kmer_distance": round(distance, 4)}
+                              for header, _, distance in potential_contamination_seqs],
+        })
+
+
+def write_result(result_file, record):
+    """
+    Writes the structured result of a sample, read by evaluate_consensus in place of the merger report
+    """
+    with open(result_file, "w") as f:
+        json.dump(record, f, indent=1)
+        f.write("\n")
 
 
 if __name__ == "__main__":
@@ -6,11 +6,27 @@ Copyright: Government of Canada
 License: MIT
 """
 import argparse
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
+import contextlib
 import glob
+import heapq
+import multiprocessing
 import os
+import pickle
+import tempfile
+
+import numpy as np
+
+from seq_io import open_binary, read_fastq, write_fasta
+
+# Class of each sequence byte: 0 for a called base, 1 for an ambiguity code or N, 2 for a lowercase low coverage base
+BASE_CLASSES = np.ones(256, dtype=np.int64)
+BASE_CLASSES[np.frombuffer(b"ACGT", dtype=np.uint8)] = 0
+BASE_CLASSES[np.frombuffer(b"abcdefghijklmnopqrstuvwxyz", dtype=np.uint8)] = 2
+
+# Most fastqs scored in one batch, each fastq usually holding a single consensus
+BATCH_SIZE = 512
+
+SCORE_HEADER = ["sample", "length", "low_quality_positions", "ambiguous", "lowercase", "mean_quality", "min_quality"]
 
 
 def main():
@@ -19,42 +35,120 @@ def main():
                         help='Directory of consensus fastqs', required=True)
     parser.add_argument('-o', type=str,
                         help='Output File', required=True)
+    parser.add_argument('-s', '--scores', type=str,
+                        help='Optional tab separated table of the scores of every consensus, in output order')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Worker processes scoring fastqs', default=1)
     args = parser.parse_args()
 
-    parse_fastq(args.d, args.o)
+    parse_fastq(args.d, args.o, args.threads, args.scores)
+
+
+def score_records(seqs, quals):
+    """
+    Scores a batch of consensus sequences in one pass over their joined sequence and quality bytes.
+    :return: List of (low quality positions, ambiguous bases, lowercase bases, mean Phred quality, minimum Phred
+    quality) tuples, where low quality positions are the ambiguous and lowercase bases
+    """
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    scores = [(0, 0, 0, 0.0, 0)] * len(seqs)
+    scored = np.flatnonzero(lengths)
+    if not len(scored):
+        return scores
+    starts = (np.cumsum(lengths) - lengths)[scored]
+    classes = BASE_CLASSES[np.frombuffer(b"".join(seqs), dtype=np.uint8)]
+    quality = np.frombuffer(b"".join(quals), dtype=np.uint8).astype(np.int64) - 33
+    ambiguous = np.add.reduceat(classes == 1, starts)
+    lowercase = np.add.reduceat(classes == 2, starts)
+    mean_quality = np.add.reduceat(quality, starts) / lengths[scored]
+    min_quality = np.minimum.reduceat(quality, starts)
+    for i, index in enumerate(scored):
+        scores[index] = (int(ambiguous[i] + lowercase[i]), int(ambiguous[i]), int(lowercase[i]),
+                         float(mean_quality[i]), int(min_quality[i]))
+    return scores
+
+
+def score_fastqs(fastqs):
+    """
+    Scores every record of a batch of consensus fastqs.
+    :return: List of (sort key, scores, basename, sequence) tuples in sort order, where records with fewer low
+    quality positions sort first and ties go to the higher mean quality
+    """
+    names, seqs, quals = [], [], []
+    for fastq in fastqs:
+        basename = os.path.basename(fastq).replace(".fq", "").encode()
+        for header, seq, qual in read_fastq(fastq):
+            names.append(basename)
+            seqs.append(bytes(seq))
+            quals.append(bytes(qual))
+    records = []
+    for index, (basename, seq, scores) in enumerate(zip(names, seqs, score_records(seqs, quals))):
+        records.append(((scores[0], -scores[3], basename, index), scores, basename, seq))
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def score_batch(job):
+    """
+    Scores a batch of fastqs and writes its sorted records to a spill file, one pickle each, so the batches can be
+    merged without holding them in memory.
+    :param job: Tuple of the batch of fastqs and the spill file
+    :return: Path of the spill file
+    """
+    fastqs, spill_file = job
+    with open(spill_file, "wb") as f:
+        for record in score_fastqs(fastqs):
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    return spill_file
+
+
+def read_spill(spill_file):
+    # Generator of the records of a spill file in their sorted order
+    with open(spill_file, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
 
 
-def parse_fastq(directory, output):
+def parse_fastq(directory, output, threads=1, scores_file=None):
     """
     Takes a fastq generated by consensus and extracts fasta sequence with basic quality metric
     Quality is deteremined by counting the presence of Ns, uncapitilized letters and degenerate bases
+    Batches of fastqs are scored in worker processes and their sorted records spilled to temporary files, which are
+    merged by their numeric key as they are written, so memory holds a batch per worker and a record per batch
     :param directory:
     :param output
+    :param threads: Worker processes scoring fastqs
+    :param scores_file: Optional table of the scores of every consensus
     :return:
     """
-    fastqs = glob.glob(os.path.join(directory, "*.fq"))
-    records = []
-    for fastq in fastqs:
-        with open(fastq) as f:
-            basename = os.path.basename(fastq).replace(".fq", "")
-            for seq in SeqIO.parse(f, "fastq"):
-
-                length = len(seq.seq)
-                good_bases = \
-                    str(seq.seq).count("A") + str(seq.seq).count("C") \
-                    + str(seq.seq).count("T") + str(seq.seq).count("G")
-                rough_quality = length - good_bases
-                record = SeqRecord(Seq(str(seq.seq)), id=basename,
-                                   description="Low Quality Positions: {}".format(rough_quality))
-                records.append(record)
-
-    # Sort list based on quality of sequences
-    records.sort(key=lambda x: int(str(x.description).replace("Low Quality Positions: ", "")))
+    fastqs = sorted(glob.glob(os.path.join(directory, "*.fq")))
+    batch_size = max(1, min(BATCH_SIZE, len(fastqs) // (threads * 4)))
+    batches = [fastqs[i:i + batch_size] for i in range(0, len(fastqs), batch_size)]
 
     # Writes fasta files to sequence
-    with open(output, "w") as g:
-        for record in records:
-            SeqIO.write(record, g, "fasta")
+    with contextlib.ExitStack() as stack:
+        spill_directory = stack.enter_context(tempfile.TemporaryDirectory())
+        jobs = [(batch, os.path.join(spill_directory, "{}.pickle".format(i))) for i, batch in enumerate(batches)]
+        if threads > 1 and len(batches) > 1:
+            with multiprocessing.Pool(threads) as pool:
+                spill_files = list(pool.imap(score_batch, jobs))
+        else:
+            spill_files = [score_batch(job) for job in jobs]
+        scored = [read_spill(spill_file) for spill_file in spill_files]
+
+        g = stack.enter_context(open_binary(output, "wb"))
+        h = stack.enter_context(open(scores_file, "w")) if scores_file else None
+        if h:
+            h.write("\t".join(SCORE_HEADER) + "\n")
+        for key, scores, basename, seq in heapq.merge(*scored, key=lambda record: record[0]):
+            rough_quality, ambiguous, lowercase, mean_quality, min_quality = scores
+            write_fasta(g, b"%s Low Quality Positions: %d" % (basename, rough_quality), seq)
+            if h:
+                h.write("{}\t{}\t{}\t{}\t{}\t{:.1f}\t{}\n".format(basename.decode(), len(seq), rough_quality, ambiguous,
+                                                               lowercase, mean_quality, min_quality))
 
 
 if __name__ == "__main__":
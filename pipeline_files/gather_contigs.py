@@ -1,30 +1,101 @@
 """
 Examines a CO1 assemblies for the presence of a high coverage appropriate length contig representing a good barcode
 sequence. Combines all good contigs into a single multi-fasta
+Every contig is classified as it is read, assemblies are examined in a pool of worker processes, and a manifest lists
+the coverage, length and class of every contig. Problem assemblies are hard linked into problem_fastas rather than
+copied.
 Author: Jackson Eyres
 Copyright: Government of Canada
 License: MIT
 """
-from Bio import SeqIO
 import os
 import glob
 import argparse
+import multiprocessing
 import shutil
 
+from seq_io import open_binary, read_fasta, write_fasta
+
+# Contigs above this coverage are good if longer than GOOD_LENGTH, or medium if longer than MEDIUM_LENGTH
+MIN_COVERAGE = 50
+GOOD_LENGTH = 600
+MEDIUM_LENGTH = 400
+
+MANIFEST_HEADER = ["specimen", "contig", "length", "coverage", "class", "assembly"]
+
 
 def main():
     parser = argparse.ArgumentParser(description='Creates a multifasta from the best SPAdes contigs')
     parser.add_argument('-s', type=str,
                         help='Folder containing SPAdes assemblies', required=True)
+    parser.add_argument('-m', type=str,
+                        help='Manifest of every contig', default="contig_manifest.tsv")
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Worker processes reading assemblies', default=1)
     args = parser.parse_args()
 
-    extract_contigs(args.s)
+    extract_contigs(args.s, args.m, args.threads)
 
 
-def extract_contigs(spades_directory):
+def classify_contig(length, coverage):
+    if coverage > MIN_COVERAGE and length > GOOD_LENGTH:
+        return "good"
+    if coverage > MIN_COVERAGE and MEDIUM_LENGTH < length <= GOOD_LENGTH:
+        return "medium"
+    return "low"
+
+
+def examine_assembly(fasta):
+    """
+    Classifies every contig of a SPAdes assembly in a single pass. SPAdes ends each contig name with its coverage.
+    An assembly is good if it has a single good contig, otherwise medium if it has a single medium contig, otherwise a
+    problem.
+    :param fasta: SPAdes assembly
+    :return: Tuple of the assembly path, its class, the (name, bases) of its chosen contig or None, and a list of
+    (header, length, coverage, class) of every contig
+    """
+    specimen_name = os.path.basename(fasta).replace(".fasta", "").encode()
+    contigs = []
+    chosen = {"good": [], "medium": []}
+    for header, bases in read_fasta(fasta):
+        try:
+            coverage = float(header.rsplit(b"_", 1)[-1])
+        except ValueError:
+            coverage = 0.0
+        length = len(bases)
+        contig_class = classify_contig(length, coverage)
+        contigs.append((header, length, coverage, contig_class))
+        if contig_class in chosen and len(chosen[contig_class]) < 2:
+            chosen[contig_class].append((specimen_name + b" " + header, bytes(bases)))
+
+    for assembly_class in ("good", "medium"):
+        if len(chosen[assembly_class]) == 1:
+            return fasta, assembly_class, chosen[assembly_class][0], contigs
+    return fasta, "problem", None, contigs
+
+
+def link_or_copy(source, destination):
+    """
+    Hard links source to destination, falling back to a symbolic link, such as across file systems, and a copy where
+    neither is supported.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), destination)
+        except OSError:
+            shutil.copy(source, destination)
+
+
+def extract_contigs(spades_directory, manifest_path="contig_manifest.tsv", threads=1):
     """
     Scans every spades assembly in a directory for a contig that appropriately looks like CO1 with high coverage.
     :param spades_directory:
+    :param manifest_path: Tab separated manifest of every contig
+    :param threads: Worker processes reading assemblies
     :return:
     """
 
@@ -35,44 +106,31 @@ def extract_contigs(spades_directory):
         print("Missing either {}".format(spades_directory))
         return
 
-    spades_fastas = glob.glob(os.path.join(spades_directory, "*.fasta"))
+    spades_fastas = sorted(glob.glob(os.path.join(spades_directory, "*.fasta")))
+
+    if threads > 1 and len(spades_fastas) > 1:
+        with multiprocessing.Pool(threads) as pool:
+            assemblies = pool.map(examine_assembly, spades_fastas,
+                                  chunksize=max(1, len(spades_fastas) // (threads * 4)))
+    else:
+        assemblies = [examine_assembly(fasta) for fasta in spades_fastas]
 
-    # Put all the contigs into a single dictionary
     final_good_contigs = []
     final_medium_contigs = []
     problematic_fastas = []
-    for fasta in spades_fastas:
-        specimen = os.path.basename(fasta)
-        specimen_name = specimen.replace(".fasta", "")
-        contigs = []
-
-        max_coverage = 0
-        for seq in SeqIO.parse(fasta, 'fasta'):
-            contigs.append(seq)
-            # Find highest coverage contig
-            coverage = float(seq.description.split("_")[-1])
-            if coverage > max_coverage:
-                max_coverage = coverage
-
-        temp_final_good_contigs = []
-        temp_final_medium_contigs = []
-        for seq in contigs:
-            length = len(seq.seq)
-            coverage = float(seq.description.split("_")[-1])
-            seq.id = specimen_name
-
-            if coverage > 50 and length > 600:
-                temp_final_good_contigs.append(seq)
-            elif coverage > 50 and 400 < length < 601:
-                temp_final_medium_contigs.append(seq)
-
-        if len(temp_final_good_contigs) == 1:
-            final_good_contigs.append(temp_final_good_contigs[0])
-
-        elif len(temp_final_medium_contigs) == 1:
-            final_medium_contigs.append(temp_final_medium_contigs[0])
-        else:
-            problematic_fastas.append(fasta)
+    with open(manifest_path, "w") as m:
+        m.write("\t".join(MANIFEST_HEADER) + "\n")
+        for fasta, assembly_class, contig, contigs in assemblies:
+            specimen = os.path.basename(fasta).replace(".fasta", "")
+            for header, length, coverage, contig_class in contigs:
+                m.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(specimen, header.decode(), length, coverage, contig_class,
+                                                          assembly_class))
+            if assembly_class == "good":
+                final_good_contigs.append(contig)
+            elif assembly_class == "medium":
+                final_medium_contigs.append(contig)
+            else:
+                problematic_fastas.append(fasta)
 
     print(len(spades_fastas))
     print("Good Quality Contigs: ", len(final_good_contigs))
@@ -88,18 +146,18 @@ def extract_contigs(spades_directory):
         for item in problematic_fastas:
             e.write(os.path.split(item)[1] + "\n")
             new_path = os.path.join("problem_fastas", os.path.split(item)[1])
-            shutil.copy(item, new_path)
+            link_or_copy(item, new_path)
 
     # Write Final Contigs to files
     final_good_path = "final_good_contigs.fasta"
-    with open(final_good_path, "w") as f:
+    with open_binary(final_good_path, "wb") as f:
         for seq in final_good_contigs:
-            SeqIO.write(seq, handle=f, format="fasta")
+            write_fasta(f, *seq)
 
     final_medium_path = "final_medium_contigs.fasta"
-    with open(final_medium_path, "w") as g:
+    with open_binary(final_medium_path, "wb") as g:
         for seq in final_medium_contigs:
-            SeqIO.write(seq, handle=g, format="fasta")
+            write_fasta(g, *seq)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+"""
+Merges the fragment A and fragment B sequences of a sample into a single CO1 contig, in place of EMBOSS merger.
+The fragments have a known overlap geometry, fragment A's tail overlaps the first 199 bases of fragment B, so only a
+band of the dynamic programming matrix around the expected overlap is aligned. If the best alignment runs into the edge
+of the band, or scores no better than unrelated sequence, the overlap lies further from the expected one and the band is
+widened, up to a limit. Fragments that don't overlap within it raise an error rather than giving a contig.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import os
+
+import numpy as np
+
+from seq_io import record_id
+
+# Bases shared by the 430 bp fragment A and 415 bp fragment B of a 646 bp contig
+EXPECTED_OVERLAP = 199
+
+# Number of diagonals either side of the expected overlap that are aligned, widened up to MAX_BAND if the alignment
+# runs into its edge. Fragment A and B pairs overlap by 119 to 279 bases at most, beyond that the two sequences are
+# something else, such as two variants of the same fragment
+BAND = 20
+MAX_BAND = 80
+
+# EDNAFULL scores for unambiguous bases and merger's default gap penalties
+MATCH = 5
+MISMATCH = -4
+GAP_OPEN = 50.0
+GAP_EXTEND = 5.0
+
+# Lowest score taken as an overlap, that of 20 matching bases. Unrelated sequence scores below zero along a diagonal,
+# and chance matches at the ends of unrelated fragments stay well under this
+MIN_SCORE = 20 * MATCH
+
+NEGATIVE_INFINITY = float("-inf")
+
+# Traceback state of the cell an alignment starts from
+START = -1
+
+
+def align_overlap(a, b, overlap=EXPECTED_OVERLAP, band=BAND):
+    """
+    Banded overlap alignment of the end of sequence a against the start of sequence b, with affine gap penalties.
+    Bases of a before the overlap and bases of b after it are end gaps, and are not penalised.
+    :param a: Sequence whose tail overlaps b, as bytes
+    :param b: Sequence whose head overlaps a, as bytes
+    :param overlap: Expected number of overlapping bases
+    :param band: Number of diagonals either side of the expected overlap to align
+    :return: Tuple of score, start of the overlap in a, end of the overlap in b, the overlap columns as a list of
+    (index in a or None, index in b or None) pairs, and whether the alignment touches an edge of the band that cuts
+    off part of the matrix, in which case a better alignment may lie outside it
+    """
+    m, n = len(a), len(b)
+    diagonal = m - overlap
+    low, high = diagonal - band, diagonal + band
+
+    # Score of alignments ending in a match (M), a gap in b (X) or a gap in a (Y) at cell i, j. Only cells with
+    # low <= i - j <= high are filled, a row at a time, stored offset by k = j - (i - high). Cell i - 1, j - 1 has
+    # the same offset in the previous row and cell i - 1, j the next one. The traceback keeps the state each cell's
+    # score came from per row, START where the alignment begins
+    width = high - low + 1
+    first = max(0, low)
+    offsets = np.arange(width)
+    a_bases = np.frombuffer(a, dtype=np.uint8)
+    # Padded so the clipped indices of cells outside b stay in range
+    b_bases = np.frombuffer(b + b"\0", dtype=np.uint8)
+    trace = np.full((m + 1 - first, 3, width), START, dtype=np.int8)
+    match_row = np.full(width, NEGATIVE_INFINITY)
+    gap_b_row = np.full(width, NEGATIVE_INFINITY)
+    gap_a_row = np.full(width, NEGATIVE_INFINITY)
+
+    for i in range(first, m + 1):
+        previous_match, previous_gap_b, previous_gap_a = match_row, gap_b_row, gap_a_row
+        row_trace = trace[i - first]
+        j = i - high + offsets
+        valid = (j >= 0) & (j <= n)
+        match_row = np.full(width, NEGATIVE_INFINITY)
+        gap_b_row = np.full(width, NEGATIVE_INFINITY)
+        if i > 0:
+            inner = valid & (j > 0)
+            pairs = np.where(a_bases[i - 1] == b_bases[np.clip(j - 1, 0, n)], MATCH, MISMATCH)
+            # Ties go to the later state, gap in a over gap in b over match
+            best = np.maximum(np.maximum(previous_match, previous_gap_b), previous_gap_a)
+            state = np.where(previous_gap_a >= best, 2, np.where(previous_gap_b >= best, 1, 0))
+            match_row = np.where(inner, best + pairs, NEGATIVE_INFINITY)
+            row_trace[0] = state
+            # Gap in b, a advances
+            opened = np.append(previous_match[1:], NEGATIVE_INFINITY) - GAP_OPEN
+            extended = np.append(previous_gap_b[1:], NEGATIVE_INFINITY) - GAP_EXTEND
+            gap_b_row = np.where(inner, np.maximum(opened, extended), NEGATIVE_INFINITY)
+            row_trace[1] = np.where(extended >= opened, 1, 0)
+        # Start of b, any earlier bases of a are free
+        start = valid & (j == 0)
+        match_row[start] = 0.0
+        row_trace[0][start] = START
+        # Gap in a, b advances. The best gap into column k opens after some earlier column k', scoring
+        # M[k'] - GAP_OPEN - GAP_EXTEND * (k - 1 - k'), so it is a running maximum of M[k'] + GAP_EXTEND * k'
+        opened = np.maximum.accumulate(match_row + GAP_EXTEND * offsets)
+        gap_a_row = np.full(width, NEGATIVE_INFINITY)
+        gap_a_row[1:] = opened[:-1] - GAP_OPEN - GAP_EXTEND * offsets[:-1]
+        gap_a_row[~valid | (j == 0)] = NEGATIVE_INFINITY
+        row_trace[2][1:] = np.where(gap_a_row[:-1] - GAP_EXTEND >= match_row[:-1] - GAP_OPEN, 2, 0)
+
+    # The overlap must run to the end of a, any later bases of b are free. Cells are taken in order of j then state
+    scores = np.stack((match_row, gap_b_row, gap_a_row), axis=1)
+    position = int(np.argmax(scores))
+    score = float(scores.flat[position])
+    if score == NEGATIVE_INFINITY:
+        return NEGATIVE_INFINITY, m, 0, [], low > -n or high < m
+    k, state = divmod(position, 3)
+    end_b = m - high + k
+
+    columns = []
+    i, j = m, end_b
+    # Extreme diagonals of the cells the alignment passes through
+    lowest = highest = i - j
+    while j > 0:
+        previous = trace[i - first, state, j - (i - high)]
+        if state == 0:
+            columns.append((i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif state == 1:
+            columns.append((i - 1, None))
+            i -= 1
+        else:
+            columns.append((None, j - 1))
+            j -= 1
+        state = previous
+        lowest, highest = min(lowest, i - j), max(highest, i - j)
+    columns.reverse()
+    clipped = (lowest <= low and low > -n) or (highest >= high and high < m)
+    return score, i, end_b, columns, clipped
+
+
+def distance_from_end(index, length):
+    return min(index, length - 1 - index)
+
+
+def merge_fragments(a_name, a, b_name, b, overlap=EXPECTED_OVERLAP, band=BAND, max_band=MAX_BAND):
+    """
+    Merges two fragments into a single contig. Both orientations are aligned, since either fragment may be the more
+    abundant, and the better scoring one is kept. While it touches the edge of the band or scores below MIN_SCORE, the
+    band is doubled and both orientations aligned again, up to max_band. Where the overlap disagrees, the base is taken
+    from the fragment in which the position lies furthest from its end, as merger does for sequences without qualities.
+    :param a_name: Name of the first sequence
+    :param a: First sequence as bytes
+    :param b_name: Name of the second sequence
+    :param b: Second sequence as bytes
+    :param overlap: Expected number of overlapping bases
+    :param band: Number of diagonals either side of the expected overlap aligned first
+    :param max_band: Widest band aligned
+    :raises ValueError: If no alignment within max_band scores MIN_SCORE without touching its edge
+    :return: Dictionary of the merged sequence and the alignment statistics
+    """
+    while True:
+        forward = align_overlap(a, b, overlap, band)
+        reverse = align_overlap(b, a, overlap, band)
+        swapped = reverse[0] > forward[0]
+        best = reverse if swapped else forward
+        # A poor best score means the overlap lies outside the band
+        if (best[0] >= MIN_SCORE and not best[4]) or band >= max_band:
+            break
+        band = min(2 * band, max_band)
+    # An alignment still on the edge of the widest band would continue outside the overlaps fragment pairs can have
+    if best[0] < MIN_SCORE or best[4]:
+        raise ValueError("No overlap found between {} and {}".format(a_name, b_name))
+    if swapped:
+        a_name, a, b_name, b = b_name, b, a_name, a
+    score, start_a, end_b, columns, _ = best
+
+    merged = bytearray(a[:start_a])
+    identity = 0
+    internal_gaps = 0
+    # Index of the next base of each fragment, to place gaps relative to the fragment ends
+    next_a, next_b = start_a, 0
+    for index_a, index_b in columns:
+        if index_a is not None and index_b is not None:
+            if a[index_a] == b[index_b]:
+                identity += 1
+                merged.append(a[index_a])
+            elif distance_from_end(index_a, len(a)) >= distance_from_end(index_b, len(b)):
+                merged.append(a[index_a])
+            else:
+                merged.append(b[index_b])
+        else:
+            # Keep an inserted base only if it lies further from its fragment's end than the gap does
+            internal_gaps += 1
+            if index_a is not None:
+                if distance_from_end(index_a, len(a)) >= distance_from_end(next_b, len(b)):
+                    merged.append(a[index_a])
+            elif distance_from_end(index_b, len(b)) > distance_from_end(next_a, len(a)):
+                merged.append(b[index_b])
+        if index_a is not None:
+            next_a = index_a + 1
+        if index_b is not None:
+            next_b = index_b + 1
+    merged.extend(b[end_b:])
+
+    length = start_a + len(columns) + len(b) - end_b
+    gaps = start_a + internal_gaps + len(b) - end_b
+    return {
+        "a_name": a_name,
+        "b_name": b_name,
+        "swapped": swapped,
+        "sequence": bytes(merged),
+        "length": length,
+        "identity": identity,
+        "similarity": identity,
+        "gaps": gaps,
+        "score": score if columns else 0.0,
+        "columns": columns,
+        "start_a": start_a,
+        "end_b": end_b,
+        "band": band,
+        "a": a,
+        "b": b,
+    }
+
+
+def percent(count, length):
+    return "{:.1f}%".format(100.0 * count / length) if length else "0.0%"
+
+
+def write_report(result, output_file):
+    """
+    Writes the alignment in the layout of an EMBOSS merger report, so the statistics sit on the same lines.
+    """
+    a_name, b_name = result["a_name"], result["b_name"]
+    length = result["length"]
+    lines = [
+        "########################################",
+        "# Program: merger",
+        "# Rundate: ",
+        "# Commandline: merge_fragments",
+        "#    -asequence {}".format(a_name),
+        "#    -bsequence {}".format(b_name),
+        "#    -outfile {}".format(os.path.basename(output_file)),
+        "#    -outseq {}".format(os.path.basename(output_file).replace(".merger", ".fasta")),
+        "# Align_format: simple",
+        "# Report_file: {}".format(os.path.basename(output_file)),
+        "########################################",
+        "",
+        "#=======================================",
+        "#",
+        "# Aligned_sequences: 2",
+        "# 1: {}".format(a_name),
+        "# 2: {}".format(b_name),
+        "# Matrix: EDNAFULL",
+        "# Gap_penalty: {}".format(GAP_OPEN),
+        "# Extend_penalty: {}".format(GAP_EXTEND),
+        "#",
+        "# Length: {}".format(length),
+        "# Identity:     {}/{} ({})".format(result["identity"], length, percent(result["identity"], length)),
+        "# Similarity:   {}/{} ({})".format(result["similarity"], length, percent(result["similarity"], length)),
+        "# Gaps:         {}/{} ({})".format(result["gaps"], length, percent(result["gaps"], length)),
+        "# Score: {}".format(result["score"]),
+        "#",
+        "#",
+        "#=======================================",
+        "",
+    ]
+
+    # Gapped rows of the full alignment, end gaps included
+    a, b = result["a"].decode(), result["b"].decode()
+    start_a, end_b = result["start_a"], result["end_b"]
+    row_a = a[:start_a]
+    row_b = "-" * start_a
+    for index_a, index_b in result["columns"]:
+        row_a += a[index_a] if index_a is not None else "-"
+        row_b += b[index_b] if index_b is not None else "-"
+    row_a += "-" * (len(b) - end_b)
+    row_b += b[end_b:]
+    markers = "".join("|" if x == y and x != "-" else " " for x, y in zip(row_a, row_b))
+
+    name_width = 20
+    position_a = position_b = 0
+    for start in range(0, len(row_a), 50):
+        block_a, block_b = row_a[start:start + 50], row_b[start:start + 50]
+        first_a = position_a + 1
+        first_b = position_b + 1
+        position_a += len(block_a) - block_a.count("-")
+        position_b += len(block_b) - block_b.count("-")
+        lines.append("{:<{}} {:>6} {} {:>6}".format(a_name[:name_width], name_width, first_a, block_a, position_a))
+        lines.append("{:<{}} {:>6} {}".format("", name_width, "", markers[start:start + 50]))
+        lines.append("{:<{}} {:>6} {} {:>6}".format(b_name[:name_width], name_width, first_b, block_b, position_b))
+        lines.append("")
+
+    lines.append("")
+    lines.append("#---------------------------------------")
+    lines.append("#---------------------------------------")
+    with open(output_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def merge_records(a_record, b_record, overlap=EXPECTED_OVERLAP, band=BAND, max_band=MAX_BAND):
+    # Merges two (header, sequence) records, naming each by its identifier as merger does
+    a_header, a_seq = a_record
+    b_header, b_seq = b_record
+    return merge_fragments(record_id(a_header).decode(), a_seq.upper(), record_id(b_header).decode(), b_seq.upper(),
+                           overlap, band, max_band)
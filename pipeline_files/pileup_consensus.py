@@ -0,0 +1,239 @@
+"""
+Builds consensus sequences from reads aligned to the CO1 reference, in place of samtools mpileup, bcftools call and
+vcfutils.pl vcf2fq. The alignments of each sorted BAM are streamed from samtools view and tallied with NumPy into a
+matrix of base counts and summed base qualities at every reference position. Each position is called as the base, or
+IUPAC code of the bases, seen in at least a fraction of its reads, lowercase where coverage is low, and dropped where
+most reads carry a deletion. Uncovered ends are trimmed and uncovered positions within are written as n. The consensus
+is written as a fastq named after the sample, as fastq_to_fasta.py expects, and a whole plate of BAMs runs in one
+process.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import os
+import re
+import subprocess
+
+import numpy as np
+
+from seq_io import IUPAC_CODES, open_binary, read_fasta, record_id, write_fastq
+
+# Alignments skipped by samtools view: unmapped, secondary and supplementary
+EXCLUDED_FLAGS = "0x904"
+
+CIGAR = re.compile(rb"(\d+)([MIDNSHP=X])")
+
+# Column of each base in the count matrix, anything else such as N is not counted
+BASE_CODES = np.full(256, 4, dtype=np.int64)
+for index, base in enumerate(b"ACGT"):
+    BASE_CODES[base] = index
+    BASE_CODES[base + 32] = index
+
+# IUPAC code of each set of bases, as a bit mask of A, C, G and T
+CONSENSUS_CODES = np.zeros(16, dtype=np.uint8)
+CONSENSUS_CODES[0] = ord("n")
+for code, bases in IUPAC_CODES.items():
+    CONSENSUS_CODES[sum(1 << "ACGT".index(base) for base in bases)] = ord(code)
+
+# Quality of reads without one, and the highest quality written
+DEFAULT_QUALITY = 30
+MAX_QUALITY = 60
+
+# Aligned blocks tallied at a time
+BATCH_SIZE = 100000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds consensus fastqs from sorted alignments to a reference')
+    parser.add_argument('-b', type=str, nargs='+',
+                        help='Sorted BAM file(s), one per sample', required=True)
+    parser.add_argument('-r', type=str,
+                        help='Reference fasta the reads were aligned to', default="pipeline_files/co1.fasta")
+    parser.add_argument('-o', type=str,
+                        help='Directory of consensus fastqs, written as SAMPLE_consensus.fq', required=True)
+    parser.add_argument('-s', '--suffix', type=str,
+                        help='Suffix removed from BAM file names to give the sample name', default="_sorted.bam")
+    parser.add_argument('--min-depth', type=int,
+                        help='Positions covered by fewer reads are written in lowercase', default=3)
+    parser.add_argument('--ambiguity', type=float,
+                        help='Fraction of reads a base needs to be part of the call', default=0.2)
+    parser.add_argument('--min-mapq', type=int,
+                        help='Alignments of lower mapping quality are skipped', default=0)
+    args = parser.parse_args()
+
+    reference = dict((record_id(header), len(seq)) for header, seq in read_fasta(args.r))
+    os.makedirs(args.o, exist_ok=True)
+    for bam in args.b:
+        sample = os.path.basename(bam)
+        if sample.endswith(args.suffix):
+            sample = sample[:-len(args.suffix)]
+        output = os.path.join(args.o, "{}_consensus.fq".format(sample))
+        called = write_consensus(bam, reference, output, args.min_depth, args.ambiguity, args.min_mapq)
+        print("{}: {} consensus positions".format(sample, called))
+
+
+def read_alignments(bam_file, min_mapq=0):
+    """
+    Generator of the SAM lines of the primary alignments of a BAM, as bytes
+    """
+    command = ["samtools", "view", "-F", EXCLUDED_FLAGS, "-q", str(min_mapq), bam_file]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        for line in process.stdout:
+            yield line
+    finally:
+        process.stdout.close()
+        if process.wait():
+            raise RuntimeError("samtools view failed on {}".format(bam_file))
+
+
+def block_positions(starts, lengths):
+    # Reference position of every base of a list of aligned blocks, laid end to end
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+
+
+def new_pileup(length):
+    """
+    :return: Dictionary of base counts, summed base qualities and deletion counts at every position of a reference
+    """
+    return {
+        "counts": np.zeros((length, 4), dtype=np.int64),
+        "qualities": np.zeros((length, 4), dtype=np.float64),
+        "deletions": np.zeros(length, dtype=np.int64),
+    }
+
+
+def add_blocks(pileup, starts, lengths, bases, qualities, deletion_starts, deletion_lengths):
+    """
+    Tallies a batch of aligned blocks, given as their reference starts and lengths with the bases and qualities of
+    every block joined together, and the reference starts and lengths of deletions.
+    """
+    length = len(pileup["deletions"])
+    if starts:
+        positions = block_positions(starts, lengths)
+        codes = BASE_CODES[np.frombuffer(bases, dtype=np.uint8)]
+        quality = np.frombuffer(qualities, dtype=np.uint8).astype(np.float64) - 33
+        kept = (codes < 4) & (positions < length)
+        index = positions[kept] * 4 + codes[kept]
+        pileup["counts"] += np.bincount(index, minlength=length * 4).reshape(length, 4)
+        pileup["qualities"] += np.bincount(index, weights=quality[kept], minlength=length * 4).reshape(length, 4)
+    if deletion_starts:
+        positions = block_positions(deletion_starts, deletion_lengths)
+        pileup["deletions"] += np.bincount(positions[positions < length], minlength=length)
+
+
+def pileup(lines, reference):
+    """
+    Tallies SAM alignments into a pileup of each reference they align to. Bases of insertions and clipped bases are
+    not counted.
+    :param lines: SAM lines as bytes
+    :param reference: Dictionary of reference name to length
+    :return: Dictionary of reference name to pileup, for references with alignments
+    """
+    pileups = {}
+    batches = {}
+    # Most reads share a handful of CIGAR strings, so each is parsed once
+    cigars = {}
+    for line in lines:
+        fields = line.rstrip(b"\r\n").split(b"\t", 11)
+        name, cigar, seq, qual = fields[2], fields[5], fields[9], fields[10]
+        if cigar == b"*" or seq == b"*" or name not in reference:
+            continue
+        if qual == b"*":
+            qual = bytes([DEFAULT_QUALITY + 33]) * len(seq)
+        batch = batches.get(name)
+        if batch is None:
+            batch = batches[name] = ([], [], [], [], [], [])
+            pileups[name] = new_pileup(reference[name])
+        starts, lengths, bases, qualities, deletion_starts, deletion_lengths = batch
+        position = int(fields[3]) - 1
+        read = 0
+        operations = cigars.get(cigar)
+        if operations is None:
+            operations = cigars[cigar] = [(int(length), operation) for length, operation in CIGAR.findall(cigar)]
+        for length, operation in operations:
+            if operation in b"M=X":
+                starts.append(position)
+                lengths.append(length)
+                bases.append(seq[read:read + length])
+                qualities.append(qual[read:read + length])
+                position += length
+                read += length
+            elif operation in b"IS":
+                read += length
+            elif operation == b"D":
+                deletion_starts.append(position)
+                deletion_lengths.append(length)
+                position += length
+            elif operation == b"N":
+                position += length
+        if len(starts) >= BATCH_SIZE:
+            flush(pileups[name], batch)
+    for name, batch in batches.items():
+        flush(pileups[name], batch)
+    return pileups
+
+
+def flush(pileup, batch):
+    starts, lengths, bases, qualities, deletion_starts, deletion_lengths = batch
+    add_blocks(pileup, starts, lengths, b"".join(bases), b"".join(qualities), deletion_starts, deletion_lengths)
+    for values in batch:
+        del values[:]
+
+
+def call_consensus(pileup, min_depth=3, ambiguity=0.2):
+    """
+    Calls the consensus of a pileup. Bases seen in at least the ambiguity fraction of a position's reads make up its
+    call, given as an IUPAC code when there are several. The quality is the mean quality of the bases called.
+    :return: Tuple of the consensus and its qualities as bytes, empty if no position is covered
+    """
+    counts = pileup["counts"]
+    deletions = pileup["deletions"]
+    depth = counts.sum(axis=1)
+    covered = np.flatnonzero(depth + deletions > 0)
+    if not len(covered):
+        return b"", b""
+    called = counts >= np.maximum(1, ambiguity * depth)[:, None]
+    called |= (counts == counts.max(axis=1)[:, None]) & (depth > 0)[:, None]
+    masks = (called * np.array([1, 2, 4, 8])).sum(axis=1)
+    consensus = CONSENSUS_CODES[masks]
+    low = (depth > 0) & (depth < min_depth)
+    consensus[low] = np.frombuffer(bytes(consensus[low]).lower(), dtype=np.uint8)
+
+    support = (counts * called).sum(axis=1)
+    quality = np.where(support > 0, (pileup["qualities"] * called).sum(axis=1) / np.maximum(support, 1), 0)
+    quality = np.clip(np.round(quality), 0, MAX_QUALITY).astype(np.uint8) + 33
+
+    # Trim uncovered ends and drop positions most reads skip with a deletion
+    kept = np.zeros(len(depth), dtype=bool)
+    kept[covered[0]:covered[-1] + 1] = True
+    kept &= deletions <= depth
+    return consensus[kept].tobytes(), quality[kept].tobytes()
+
+
+def write_consensus(bam_file, reference, output_file, min_depth=3, ambiguity=0.2, min_mapq=0):
+    """
+    Writes the consensus of a sample to a fastq with a record for each reference its reads aligned to. The fastq is
+    empty if no reads aligned.
+    :param bam_file: Sorted BAM of the sample
+    :param reference: Dictionary of reference name to length
+    :param output_file: Consensus fastq
+    :return: Number of consensus positions written
+    """
+    pileups = pileup(read_alignments(bam_file, min_mapq), reference)
+    written = 0
+    with open_binary(output_file, "wb") as g:
+        for name in sorted(pileups):
+            seq, qual = call_consensus(pileups[name], min_depth, ambiguity)
+            if seq:
+                write_fastq(g, name, seq, qual)
+                written += len(seq)
+    return written
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Scales the threads, memory and runtime of the Snakemake rules with the depth of the samples they process. Depth is
+the number of read pairs of a sample, estimated from its R1 fastq by decompressing the first megabyte and scaling the
+reads found there by the file size, so even deep plates are sized in milliseconds. Every rule has a linear model of
+memory and CPU time in millions of read pairs. The defaults below are conservative, and can be calibrated from the
+Benchmark_Jobs.tsv of a finished run by running this script, which writes the fitted models to resources.json.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import functools
+import json
+import math
+import os
+import zlib
+
+from benchmark_report import chunk_samples, collect_jobs
+
+# Decompressed bytes of a fastq sampled to estimate its reads, and the compressed bytes read at a time to get there
+SAMPLE_BYTES = 1 << 20
+READ_SIZE = 1 << 12
+
+# zlib window bits that accept a gzip header
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Headroom given over the fitted memory and runtime, as jobs past their limits are killed
+MEMORY_MARGIN = 1.2
+RUNTIME_MARGIN = 2.0
+
+# Share of a JVM job's memory given to the heap, the rest covers the JVM itself
+HEAP_FRACTION = 0.85
+
+# Per rule models, in millions of read pairs (M):
+# threads = M / million_reads_per_thread, from min_threads (1 if not given) to max_threads
+# mem_mb = base_mb + mb_per_million_reads * M, up to max_mb
+# runtime = base_s + cpu_s_per_million_reads * M / threads
+# Memory isn't calibrated for JVM rules, whose resident memory follows the heap they are given rather than their need
+DEFAULT_MODEL = {
+    "bbduk": {"million_reads_per_thread": 0.1, "max_threads": 8, "base_mb": 1000, "mb_per_million_reads": 200,
+              "max_mb": 8000, "base_s": 10, "cpu_s_per_million_reads": 60, "jvm": True},
+    "bbmerge": {"million_reads_per_thread": 0.1, "max_threads": 8, "base_mb": 1000, "mb_per_million_reads": 500,
+                "max_mb": 16000, "base_s": 10, "cpu_s_per_million_reads": 120, "jvm": True},
+    "stream_trim": {"million_reads_per_thread": 0.1, "min_threads": 3, "max_threads": 8, "base_mb": 2000, "mb_per_million_reads": 700,
+                    "max_mb": 16000, "base_s": 20, "cpu_s_per_million_reads": 200, "jvm": True},
+    "remove_primers": {"million_reads_per_thread": 0.25, "max_threads": 4, "base_mb": 200,
+                       "mb_per_million_reads": 150, "max_mb": 8000, "base_s": 2, "cpu_s_per_million_reads": 12,
+                       "jvm": False},
+    "remove_primers_batch": {"million_reads_per_thread": 0.25, "max_threads": 8, "base_mb": 200,
+                             "mb_per_million_reads": 100, "max_mb": 8000, "base_s": 5, "cpu_s_per_million_reads": 12,
+                             "jvm": False},
+    "vsearch": {"million_reads_per_thread": 1, "max_threads": 1, "base_mb": 100, "mb_per_million_reads": 500,
+                "max_mb": 8000, "base_s": 2, "cpu_s_per_million_reads": 10, "jvm": False},
+    "evaluate_vsearch": {"million_reads_per_thread": 1, "max_threads": 1, "base_mb": 200, "mb_per_million_reads": 200,
+                         "max_mb": 4000, "base_s": 2, "cpu_s_per_million_reads": 5, "jvm": False},
+    "evaluate_consensus": {"million_reads_per_thread": 1, "max_threads": 8, "base_mb": 500,
+                           "mb_per_million_reads": 10, "max_mb": 4000, "base_s": 10, "cpu_s_per_million_reads": 1,
+                           "jvm": False},
+    "map_reads": {"million_reads_per_thread": 0.05, "min_threads": 2, "max_threads": 16, "base_mb": 2000, "mb_per_million_reads": 500,
+                  "max_mb": 16000, "base_s": 20, "cpu_s_per_million_reads": 300, "jvm": True},
+    "process_chunk": {"million_reads_per_thread": 0.25, "max_threads": 8, "base_mb": 2000,
+                      "mb_per_million_reads": 1000, "max_mb": 32000, "base_s": 30, "cpu_s_per_million_reads": 250,
+                      "jvm": True},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrates the resource model of the workflow rules from a finished '
+                                                 'run')
+    parser.add_argument('-j', type=str,
+                        help='Table of every job from benchmark_report.py', default="Benchmark_Jobs.tsv")
+    parser.add_argument('-b', type=str,
+                        help='Directory of benchmark files, used if the table is missing', default="benchmarks")
+    parser.add_argument('-l', type=str,
+                        help='Directory of log files', default="logs")
+    parser.add_argument('-d', type=str,
+                        help='Directory of paired fastq.gz files', default="fastq")
+    parser.add_argument('--r1', type=str,
+                        help='Suffix of R1 files', default="_L001_R1_001.fastq.gz")
+    parser.add_argument('-m', type=str,
+                        help='Model to start from, the defaults if missing', default="resources.json")
+    parser.add_argument('-o', type=str,
+                        help='Calibrated model', default="resources.json")
+    args = parser.parse_args()
+
+    model = load_model(args.m)
+    jobs = read_jobs(args.j) if os.path.isfile(args.j) else collect_jobs(args.b, args.l)
+    samples = [name[:-len(args.r1)] for name in os.listdir(args.d) if name.endswith(args.r1)] \
+        if os.path.isdir(args.d) else []
+    for job in jobs:
+        job["million_reads"] = job_read_pairs(job, samples, args.d, args.r1, args.l) / 1e6
+    model = calibrate(model, jobs)
+    with open(args.o, "w") as f:
+        json.dump(model, f, indent=1, sort_keys=True)
+    print("Wrote the calibrated model of {} rules to {}".format(len(model), args.o))
+
+
+def load_model(model_file):
+    """
+    Returns the default model with any rules or coefficients of model_file in place of the defaults.
+    :param model_file: JSON file of calibrated models, ignored if missing
+    :return: Dictionary of rule name to dictionary of coefficients
+    """
+    model = dict((rule, dict(coefficients)) for rule, coefficients in DEFAULT_MODEL.items())
+    if model_file and os.path.isfile(model_file):
+        with open(model_file) as f:
+            for rule, coefficients in json.load(f).items():
+                model.setdefault(rule, {}).update(coefficients)
+    return model
+
+
+def estimate_reads(fastq_file):
+    """
+    Estimates the reads of a plain or gzipped fastq from its first SAMPLE_BYTES of sequence, exact for smaller files.
+    Estimates are cached by the size and modification time of the file, as Snakemake asks for them for every resource
+    of every job.
+    :return: Estimated number of reads, 0 if the file is missing
+    """
+    try:
+        stat = os.stat(fastq_file)
+    except OSError:
+        return 0
+    return cached_estimate(fastq_file, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def cached_estimate(fastq_file, size, mtime):
+    if size == 0:
+        return 0
+    newlines, consumed, complete = sample_lines(fastq_file)
+    if complete or not consumed:
+        return newlines // 4
+    return int(newlines / 4 * size / consumed)
+
+
+def sample_lines(fastq_file):
+    """
+    Counts the lines of the first SAMPLE_BYTES of a fastq, decompressing gzip members as they come.
+    :return: Tuple of the lines counted, the bytes of the file read to find them and whether the whole file was read
+    """
+    newlines = decompressed = 0
+    with open(fastq_file, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+        f.seek(0)
+        decompressor = zlib.decompressobj(GZIP_WBITS) if gzipped else None
+        while decompressed < SAMPLE_BYTES:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                return newlines, f.tell(), True
+            while chunk:
+                data = decompressor.decompress(chunk) if gzipped else chunk
+                chunk = b""
+                if gzipped and decompressor.eof:
+                    # Start of the next gzip member, as bgzip and concatenated files have
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                newlines += data.count(b"\n")
+                decompressed += len(data)
+        return newlines, f.tell(), False
+
+
+def rule_threads(model, rule, reads):
+    coefficients = model[rule]
+    million_reads = reads / 1e6
+    return max(coefficients.get("min_threads", 1),
+               min(coefficients["max_threads"], int(math.ceil(million_reads / coefficients["million_reads_per_thread"]))))
+
+
+def rule_mem_mb(model, rule, reads):
+    coefficients = model[rule]
+    mem_mb = (coefficients["base_mb"] + coefficients["mb_per_million_reads"] * reads / 1e6) * MEMORY_MARGIN
+    return int(math.ceil(min(coefficients["max_mb"], mem_mb)))
+
+
+def rule_runtime(model, rule, reads, threads):
+    # Runtime in minutes, as Snakemake expects
+    coefficients = model[rule]
+    seconds = coefficients["base_s"] + coefficients["cpu_s_per_million_reads"] * reads / 1e6 / threads
+    return max(1, int(math.ceil(seconds * RUNTIME_MARGIN / 60)))
+
+
+def threads_of(model, rule, reads):
+    """
+    The functions below give Snakemake the threads, memory and runtime of a rule.
+    :param model: Dictionary from load_model
+    :param rule: Name of the rule's model
+    :param reads: Function of a job's wildcards returning the read pairs it processes
+    """
+    return lambda wildcards: rule_threads(model, rule, reads(wildcards))
+
+
+def mem_mb_of(model, rule, reads):
+    return lambda wildcards: rule_mem_mb(model, rule, reads(wildcards))
+
+
+def runtime_of(model, rule, reads):
+    return lambda wildcards, threads: rule_runtime(model, rule, reads(wildcards), threads)
+
+
+def java_heap(jvms=1, share=1.0):
+    # -Xmx flag of the BBTools of a job, sharing the job's share of memory between the JVMs running at once and
+    # leaving room for each
+    return lambda wildcards, resources: "-Xmx{}m".format(int(resources.mem_mb * share * HEAP_FRACTION / jvms))
+
+
+def split_threads(threads, weights):
+    """
+    Splits the threads of a job between the processes of a pipe, in proportion to their weights. Every process gets at
+    least one thread, so the shares only sum to threads when there are at least as many threads as processes.
+    :param threads: Threads of the job
+    :param weights: Relative CPU time of each process
+    :return: List of the threads of each process
+    """
+    shares = [1] * len(weights)
+    for _ in range(threads - len(weights)):
+        # Each thread goes to the process with the most CPU time per thread
+        process = max(range(len(weights)), key=lambda i: weights[i] / shares[i])
+        shares[process] += 1
+    return shares
+
+
+def pipe_threads(weights, process):
+    # Threads of one process of a piped job, from split_threads
+    return lambda wildcards, threads: split_threads(threads, weights)[process]
+
+
+def read_jobs(jobs_file):
+    """
+    Reads the table of jobs benchmark_report.py writes.
+    :return: List of dictionaries of the stage, job, cpu_s and max_rss_mb of each job, None where not measured
+    """
+    jobs = []
+    with open(jobs_file) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        for line in f:
+            row = dict(zip(header, line.rstrip("\n").split("\t")))
+            job = {"stage": row["stage"], "job": row["job"]}
+            for column in ("cpu_s", "max_rss_mb"):
+                try:
+                    job[column] = float(row[column])
+                except (KeyError, ValueError):
+                    job[column] = None
+            jobs.append(job)
+    return jobs
+
+
+def job_read_pairs(job, samples, fastq_directory, r1_suffix, log_directory):
+    """
+    Read pairs a benchmarked job processed, estimated from the R1 fastq of its samples as the workflow does. Jobs are
+    a sample, a chunk whose log lists its samples, or the whole plate.
+    """
+    if job["job"] == "plate":
+        job_samples = samples
+    else:
+        job_samples = chunk_samples(os.path.join(log_directory, "{}.log".format(job["job"]))) or [job["job"]]
+    return sum(estimate_reads(os.path.join(fastq_directory, sample + r1_suffix)) for sample in job_samples)
+
+
+def fit_line(x, y, intercept, slope):
+    """
+    Least squares line of y in x, clamped to a non-negative intercept and slope. With fewer than two distinct x the
+    given line is scaled to pass through the mean of y instead.
+    :return: Tuple of intercept and slope
+    """
+    mean_x = sum(x) / len(x)
+    mean_y = sum(y) / len(y)
+    spread = sum((value - mean_x) ** 2 for value in x)
+    if spread > 0:
+        slope = sum((a - mean_x) * (b - mean_y) for a, b in zip(x, y)) / spread
+        fitted = mean_y - slope * mean_x
+        if slope < 0:
+            return max(0.0, mean_y), 0.0
+        if fitted < 0:
+            # Refit through the origin
+            return 0.0, sum(a * b for a, b in zip(x, y)) / sum(a * a for a in x)
+        return fitted, slope
+    scale = mean_y / (intercept + slope * mean_x) if intercept + slope * mean_x > 0 else 1.0
+    return intercept * scale, slope * scale
+
+
+def calibrate(model, jobs):
+    """
+    Fits the CPU seconds and, for rules outside the JVM, the peak memory of each rule to the read pairs of its jobs.
+    Rules without benchmarked jobs that processed any reads keep their coefficients.
+    :param model: Dictionary from load_model
+    :param jobs: List of dictionaries with stage, cpu_s, max_rss_mb and million_reads of each job
+    :return: Calibrated model
+    """
+    for rule, coefficients in model.items():
+        rule_jobs = [job for job in jobs if job["stage"] == rule and job["million_reads"] > 0]
+        timed = [job for job in rule_jobs if job["cpu_s"] is not None]
+        if timed:
+            coefficients["base_s"], coefficients["cpu_s_per_million_reads"] = fit_line(
+                [job["million_reads"] for job in timed], [job["cpu_s"] for job in timed], coefficients["base_s"],
+                coefficients["cpu_s_per_million_reads"])
+        measured = [job for job in rule_jobs if job["max_rss_mb"] is not None]
+        if measured and not coefficients.get("jvm"):
+            coefficients["base_mb"], coefficients["mb_per_million_reads"] = fit_line(
+                [job["million_reads"] for job in measured], [job["max_rss_mb"] for job in measured],
+                coefficients["base_mb"], coefficients["mb_per_million_reads"])
+    return model
+
+
+if __name__ == "__main__":
+    main()
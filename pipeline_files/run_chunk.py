@@ -0,0 +1,161 @@
+"""
+Runs the per sample chain of the Snakefile, bbduk, bbmerge, primer trimming, vsearch and evaluate_vsearch, for a chunk
+of samples inside a single job, and folds their results into the plate's summary. The conda environment is activated once per chunk rather than once per sample and
+step, and primer trimming and contig extraction run in this process rather than a new interpreter per sample.
+Outputs and logs of each sample are the same as the per sample rules write. The samples and the time spent in each
+step are printed.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import contextlib
+import os
+import subprocess
+import time
+import traceback
+
+from evaluate_consensus import evaluate
+from evaluate_vsearch import extract_contig
+from resources import HEAP_FRACTION
+from trim_primers import find_primers_batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the per sample steps of the pipeline for a chunk of samples')
+    parser.add_argument('-s', type=str, nargs='+',
+                        help='Sample names', required=True)
+    parser.add_argument('-a', type=str,
+                        help='Adaptor fasta for bbduk', required=True)
+    parser.add_argument('-p', type=str,
+                        help='Primer File in .fasta format', required=True)
+    parser.add_argument('-e', '--extension', type=str,
+                        help='Extension of the merged, unmerged and sliced reads, .fq.gz to gzip them', default=".fq")
+    parser.add_argument('--fused', action='store_true',
+                        help='Dereplicate reads while trimming primers, skipping the sliced reads and vsearch')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Number of threads given to each step', default=1)
+    parser.add_argument('-m', '--memory', type=int,
+                        help='Memory of the job in MB, sizing the BBTools heap. The JVM default if omitted')
+    args = parser.parse_args()
+
+    run_chunk(args.s, args.a, args.p, args.fused, args.threads, args.extension, args.memory)
+
+
+def run_chunk(samples, adaptors, primers, fused=False, threads=1, extension=".fq", memory=None):
+    """
+    Runs each step over every sample of the chunk before moving to the next, so the primer index and worker pool of
+    trim_primers are built once for the chunk.
+    :param samples: Sample names
+    :param adaptors: Adaptor fasta for bbduk
+    :param primers: Primer fasta for trim_primers
+    :param fused: Write the dereplicated reads while trimming rather than running vsearch
+    :param threads: Number of threads given to each step
+    :param extension: Extension of the merged, unmerged and sliced reads
+    :param memory: Memory of the job in MB, sizing the BBTools heap. The JVM default if None
+    :return: Dictionary of seconds spent in each step
+    """
+    timings = {}
+    java = ["-Xmx{}m".format(int(memory * HEAP_FRACTION))] if memory else []
+    print("Samples: {}".format(" ".join(samples)))
+
+    start = time.perf_counter()
+    for sample in samples:
+        r1, r2 = trimmed_reads(sample)
+        run_command(["bbduk.sh"] + java + ["in1=fastq/{}_L001_R1_001.fastq.gz".format(sample), "out1=" + r1,
+                                           "in2=fastq/{}_L001_R2_001.fastq.gz".format(sample), "out2=" + r2,
+                                           "ref=" + adaptors, "qtrim=rl", "trimq=10", "ktrim=r", "k=23", "mink=11",
+                                           "hdist=1", "tpe", "tbo", "threads={}".format(threads)],
+                    "logs/bbduk.{}.log".format(sample), [r1, r2])
+    timings["bbduk"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for sample in samples:
+        r1, r2 = trimmed_reads(sample)
+        merged = "merged/{}_merged{}".format(sample, extension)
+        unmerged = "unmerged/{}_unmerged{}".format(sample, extension)
+        run_command(["bbmerge.sh"] + java + ["in=" + r1, "in2=" + r2, "outm=" + merged, "outu=" + unmerged,
+                                             "threads={}".format(threads)],
+                    "logs/bbmerge.{}.log".format(sample), [merged, unmerged])
+    timings["bbmerge"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    trim_samples = []
+    for sample in samples:
+        trim_samples.append(("merged/{}_merged{}".format(sample, extension),
+                             None if fused else "sliced/{}_sliced{}".format(sample, extension),
+                             "logs/slice.{}.log".format(sample),
+                             "vsearch/{}.fas".format(sample) if fused else None,
+                             "stats/slice.{}.json".format(sample)))
+    make_directories([path for trim_sample in trim_samples for path in trim_sample if path])
+    find_primers_batch(trim_samples, primers, threads)
+    timings["remove_primers"] = time.perf_counter() - start
+
+    if not fused:
+        start = time.perf_counter()
+        for sample in samples:
+            output = "vsearch/{}.fas".format(sample)
+            run_command(["vsearch", "--derep_fulllength", "sliced/{}_sliced{}".format(sample, extension),
+                         "--sizein", "--fasta_width", "0", "--sizeout", "--output", output],
+                        "logs/vsearch.{}.log".format(sample), [output])
+        timings["vsearch"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for sample in samples:
+        output_directory = "consensus/{}".format(sample)
+        log_file = "logs/consensus.{}.log".format(sample)
+        make_directories([log_file, os.path.join(output_directory, sample)])
+        with open(log_file, "w") as log, contextlib.redirect_stdout(log):
+            try:
+                extract_contig("vsearch/{}.fas".format(sample), output_directory)
+            except Exception:
+                # Failures of a sample are logged and its outputs left empty, as the per sample rule does
+                traceback.print_exc(file=log)
+        touch([os.path.join(output_directory, sample + suffix)
+               for suffix in (".fasta", "_contamination.fasta", ".json")])
+    timings["evaluate_vsearch"] = time.perf_counter() - start
+
+    # Folds the chunk into the plate's cached results as soon as it finishes, the outputs are written once at the end
+    start = time.perf_counter()
+    evaluate("consensus", samples)
+    timings["evaluate_consensus"] = time.perf_counter() - start
+
+    for step, seconds in timings.items():
+        print("{}: {:.2f}s for {} samples, {:.3f}s per sample".format(step, seconds, len(samples),
+                                                                     seconds / len(samples)))
+    return timings
+
+
+def trimmed_reads(sample):
+    return ("trimmed/{}_trimmed_L001_R1_001.fastq.gz".format(sample),
+            "trimmed/{}_trimmed_L001_R2_001.fastq.gz".format(sample))
+
+
+def run_command(command, log_file, outputs):
+    """
+    Runs a command with its output written to log_file. As with the per sample rules, a failed command doesn't stop
+    the chunk and its outputs are touched so downstream steps can report the sample as missing.
+    """
+    make_directories([log_file] + outputs)
+    with open(log_file, "w") as log:
+        try:
+            subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            log.write("Could not run {}: {}\n".format(command[0], e))
+    touch(outputs)
+
+
+def make_directories(paths):
+    for directory in set(os.path.dirname(path) for path in paths):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+
+def touch(paths):
+    for path in paths:
+        with open(path, "a"):
+            os.utime(path, None)
+
+
+if __name__ == "__main__":
+    main()
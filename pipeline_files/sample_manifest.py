@@ -0,0 +1,180 @@
+"""
+Builds and caches the sample sheet of paired end fastq files the Snakemake workflows run on. The sheet records each
+sample's R1 and R2 files with their sizes and modification times, and the modification time of the fastq directory.
+While the directory is unchanged the workflow loads the sheet without listing the directory or touching the fastqs.
+When fastqs are added or removed the sheet is refreshed incrementally, only the new fastqs are examined. Fastqs
+rewritten in place under the same name don't change the directory, run this script with --verify to check every
+fastq against the sheet. Unpaired or misnamed fastqs are reported when the sheet is built, rather than failing jobs
+later.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import argparse
+import os
+import sys
+
+HEADER = ["sample", "r1", "r2", "r1_size", "r1_mtime", "r2_size", "r2_mtime"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds or refreshes the sample sheet of a fastq directory')
+    parser.add_argument('-d', type=str,
+                        help='Directory of paired fastq.gz files', default="fastq")
+    parser.add_argument('-o', type=str,
+                        help='Sample sheet', default="samples.tsv")
+    parser.add_argument('--r1', type=str,
+                        help='Suffix of R1 files', default="_L001_R1_001.fastq.gz")
+    parser.add_argument('--r2', type=str,
+                        help='Suffix of R2 files', default="_L001_R2_001.fastq.gz")
+    parser.add_argument('--verify', action='store_true',
+                        help='Check every fastq against the size and modification time of the sheet, and update the '
+                             'samples whose fastqs were rewritten')
+    args = parser.parse_args()
+
+    if args.verify:
+        rewritten = verify_sample_sheet(args.d, args.o)
+        if rewritten:
+            print("Fastqs rewritten since {} was built: {}".format(args.o, ", ".join(rewritten)), file=sys.stderr)
+    samples = load_samples(args.d, args.r1, args.r2, args.o)
+    print("{} samples in {}".format(len(samples), args.o))
+
+
+def load_samples(fastq_directory, r1_suffix, r2_suffix, sample_sheet):
+    """
+    Returns the sorted sample names of a fastq directory, from the cached sample sheet if the directory hasn't changed
+    since it was written, otherwise refreshing the sheet first.
+    :param fastq_directory: Directory of paired fastq.gz files
+    :param r1_suffix: Suffix that follows the sample name in R1 files
+    :param r2_suffix: Suffix that follows the sample name in R2 files
+    :param sample_sheet: Path of the cached sample sheet
+    :return: List of sample names
+    """
+    if not os.path.isdir(fastq_directory):
+        return []
+    directory_mtime = os.stat(fastq_directory).st_mtime_ns
+    cached_mtime, rows = read_sample_sheet(sample_sheet)
+    if cached_mtime == directory_mtime:
+        return [row["sample"] for row in rows]
+
+    refreshed = refresh_sample_sheet(fastq_directory, r1_suffix, r2_suffix, rows)
+    write_sample_sheet(sample_sheet, directory_mtime, refreshed)
+    return [row["sample"] for row in refreshed]
+
+
+def verify_sample_sheet(fastq_directory, sample_sheet):
+    """
+    Checks every fastq of the sample sheet against its recorded size and modification time, and records those of the
+    samples that differ. Samples whose fastqs are missing are left for the next refresh to drop.
+    :return: Sorted samples whose R1 or R2 was rewritten
+    """
+    directory_mtime, rows = read_sample_sheet(sample_sheet)
+    rewritten = []
+    for row in rows:
+        r1, r2 = file_signature(row["r1"]), file_signature(row["r2"])
+        recorded = (row["r1_size"], row["r1_mtime"]), (row["r2_size"], row["r2_mtime"])
+        if r1 is None or r2 is None or (r1, r2) == recorded:
+            continue
+        (row["r1_size"], row["r1_mtime"]), (row["r2_size"], row["r2_mtime"]) = r1, r2
+        rewritten.append(row["sample"])
+    if rewritten:
+        write_sample_sheet(sample_sheet, directory_mtime, rows)
+    return rewritten
+
+
+def file_signature(path):
+    # Size and modification time of a file, None if it is missing
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_sample_sheet(sample_sheet):
+    """
+    :return: Tuple of the fastq directory modification time the sheet was built at and its rows, (None, []) if there
+    is no readable sheet
+    """
+    try:
+        with open(sample_sheet) as f:
+            directory_mtime = int(f.readline().strip().split("=")[1])
+            header = f.readline().rstrip("\n").split("\t")
+            if header != HEADER:
+                return None, []
+            rows = []
+            for line in f:
+                row = dict(zip(HEADER, line.rstrip("\n").split("\t")))
+                for column in ("r1_size", "r1_mtime", "r2_size", "r2_mtime"):
+                    row[column] = int(row[column])
+                rows.append(row)
+            return directory_mtime, rows
+    except (IOError, OSError, IndexError, KeyError, ValueError):
+        return None, []
+
+
+def refresh_sample_sheet(fastq_directory, r1_suffix, r2_suffix, rows):
+    """
+    Lists the fastq directory once and pairs R1 and R2 files by sample name. Fastqs already in the sheet keep their
+    recorded size and modification time, only fastqs new to the sheet are stat'ed, and fastqs no longer listed drop
+    out.
+    :param rows: Rows of the cached sample sheet, empty if there is none
+    :raises ValueError: If a fastq doesn't match either suffix, or a sample is missing its R1 or R2
+    :return: Rows sorted by sample
+    """
+    recorded = {}
+    for row in rows:
+        recorded[row["r1"]] = (row["r1_size"], row["r1_mtime"])
+        recorded[row["r2"]] = (row["r2_size"], row["r2_mtime"])
+
+    reads = {}
+    misnamed = []
+    for entry in os.scandir(fastq_directory):
+        if not entry.name.endswith(".fastq.gz"):
+            continue
+        if entry.name.endswith(r1_suffix):
+            sample, read = entry.name[:-len(r1_suffix)], "r1"
+        elif entry.name.endswith(r2_suffix):
+            sample, read = entry.name[:-len(r2_suffix)], "r2"
+        else:
+            misnamed.append(entry.name)
+            continue
+        signature = recorded.get(entry.path)
+        if signature is None:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+        reads.setdefault(sample, {})[read] = (entry.path,) + signature
+
+    unpaired = sorted(sample for sample, pair in reads.items() if len(pair) != 2)
+    if misnamed or unpaired:
+        message = []
+        if misnamed:
+            message.append("fastqs not ending in {} or {}: {}".format(r1_suffix, r2_suffix,
+                                                                      ", ".join(sorted(misnamed))))
+        if unpaired:
+            message.append("samples missing R1 or R2: {}".format(", ".join(unpaired)))
+        raise ValueError("Invalid fastqs in {}, {}".format(fastq_directory, "; ".join(message)))
+
+    refreshed = []
+    for sample in sorted(reads):
+        (r1, r1_size, r1_mtime), (r2, r2_size, r2_mtime) = reads[sample]["r1"], reads[sample]["r2"]
+        refreshed.append({"sample": sample, "r1": r1, "r2": r2, "r1_size": r1_size, "r1_mtime": r1_mtime,
+                          "r2_size": r2_size, "r2_mtime": r2_mtime})
+    return refreshed
+
+
+def write_sample_sheet(sample_sheet, directory_mtime, rows):
+    # Written to a temporary file then moved into place, so concurrent readers never see a partial sheet
+    temporary = sample_sheet + ".tmp"
+    with open(temporary, "w") as f:
+        f.write("# directory_mtime={}\n".format(directory_mtime))
+        f.write("\t".join(HEADER) + "\n")
+        for row in rows:
+            f.write("\t".join(str(row[column]) for column in HEADER) + "\n")
+    os.replace(temporary, sample_sheet)
+
+
+if __name__ == "__main__":
+    main()
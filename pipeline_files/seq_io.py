@@ -0,0 +1,260 @@
+"""
+Lightweight fastq and fasta reading and writing shared by the pipeline scripts. Records are returned as tuples of byte
+strings sliced straight out of fixed size blocks of the file, rather than Biopython SeqRecords with per-letter quality
+lists, and are written back without building any objects. Fastq files are read a block at a time so memory stays flat
+however large the file.
+Files ending in .gz or .zst are compressed and decompressed transparently, with python-isal's threaded gzip when it is
+installed and zstandard for .zst files. Older python-isal releases without igzip_threaded fall back to its single
+threaded igzip, and to the standard library's gzip without python-isal, with a warning either way.
+Author: Jackson Eyres
+Copyright: Government of Canada
+License: MIT
+"""
+import contextlib
+import gzip
+import io
+import mmap
+import sys
+import warnings
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+try:
+    # Added in python-isal 1.4
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Path standing for stdin or stdout, so the scripts can be joined by pipes
+STDIO = "-"
+
+# Compression levels of written files. Low levels compress fastq nearly as well as the defaults in a fraction of the time
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+
+# Threads compressing or decompressing alongside the thread parsing reads
+COMPRESSION_THREADS = 1
+
+# Bytes of a fastq file parsed at a time
+BLOCK_SIZE = 1 << 20
+
+# Bases each IUPAC nucleotide code can stand for
+IUPAC_CODES = {
+    "A": "A", "C": "C", "G": "G", "T": "T",
+    "R": "AG", "Y": "CT", "S": "GC", "W": "AT", "K": "GT", "M": "AC",
+    "B": "CGT", "D": "AGT", "H": "ACT", "V": "ACG", "N": "ACGT",
+}
+
+
+def map_file(handle):
+    """
+    Memory maps an open binary file for reading. Files that can't be mapped, such as empty files and pipes, are
+    returned as the handle itself so callers can fall back to reading line by line.
+    :param handle: File opened in binary mode
+    :return: mmap or the original handle
+    """
+    try:
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, AttributeError):
+        return handle
+
+
+def compression(path):
+    """
+    :return: "gz" or "zst" for compressed files, None for plain files and standard streams
+    """
+    if path.endswith(".gz"):
+        return "gz"
+    if path.endswith(".zst"):
+        return "zst"
+    return None
+
+
+def open_binary(path, mode="rb", threads=COMPRESSION_THREADS):
+    """
+    Opens a file in binary mode, or stdin or stdout if the path is "-". The standard streams are left open when the
+    returned context exits. Files ending in .gz or .zst are compressed or decompressed on the fly.
+    :param path:
+    :param mode: "rb" or "wb"
+    :param threads: Threads compressing or decompressing the file, where the library supports them
+    :return: Context manager of a binary handle
+    """
+    if path == STDIO:
+        return contextlib.nullcontext(sys.stdin.buffer if "r" in mode else sys.stdout.buffer)
+    kind = compression(path)
+    if kind == "gz":
+        if igzip_threaded is not None:
+            return igzip_threaded.open(path, mode, compresslevel=GZIP_LEVEL, threads=threads)
+        if igzip is not None:
+            warnings.warn("python-isal is older than 1.4, gzip files are compressed and decompressed on a single "
+                          "thread", RuntimeWarning)
+            return igzip.open(path, mode, compresslevel=GZIP_LEVEL)
+        warnings.warn("python-isal is not installed, gzip files are compressed and decompressed by the much slower "
+                      "gzip module", RuntimeWarning)
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+    if kind == "zst":
+        if zstandard is None:
+            raise ImportError("The zstandard package is needed to read or write {}".format(path))
+        if "r" in mode:
+            # Buffered so the reader can be iterated line by line
+            return io.BufferedReader(zstandard.open(path, "rb"))
+        return zstandard.open(path, "wb", cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=threads))
+    return open(path, mode)
+
+
+def read_fastq(path, block_size=BLOCK_SIZE):
+    """
+    Generator of (header, sequence, quality) byte strings for every record of a 4 line per record fastq file. The
+    header excludes the leading @. A path of "-" reads stdin. Plain, compressed and piped files alike are parsed a
+    block at a time, so only a block and the records being used are held in memory.
+    :param path:
+    :param block_size: Bytes read at a time
+    :return:
+    """
+    with open_binary(path) as f:
+        yield from parse_fastq_blocks(f, block_size)
+
+
+def parse_fastq_blocks(handle, block_size=BLOCK_SIZE):
+    """
+    Generator of (header, sequence, quality) byte strings from a binary file handle, read block_size bytes at a time.
+    A record cut off by the end of a block is carried over to the next.
+    :param handle:
+    :param block_size:
+    :return:
+    """
+    remainder = b""
+    offset = 0
+    while True:
+        block = handle.read(block_size)
+        buffer = remainder + block if remainder else block
+        consumed = yield from parse_fastq_records(buffer, final=not block, offset=offset)
+        if not block:
+            return
+        remainder = buffer[consumed:]
+        offset += consumed
+
+
+def parse_fastq(buffer):
+    """
+    Generator of (header, sequence, quality) byte strings from a bytes-like buffer of fastq text
+    :param buffer: bytes or mmap
+    :return:
+    """
+    yield from parse_fastq_records(buffer)
+
+
+def parse_fastq_records(buffer, final=True, offset=0):
+    """
+    Generator of (header, sequence, quality) byte strings of the complete records of a buffer of fastq text
+    :param buffer: bytes or mmap
+    :param final: Whether the buffer ends the file. If not, a record cut off at the end is left unparsed
+    :param offset: Position of the buffer in the file, for error messages
+    :return: Position of the first byte not parsed
+    """
+    position = 0
+    end = len(buffer)
+    find = buffer.find
+    while position < end:
+        header_end = find(b"\n", position)
+        seq_end = find(b"\n", header_end + 1)
+        plus_end = find(b"\n", seq_end + 1)
+        qual_end = find(b"\n", plus_end + 1)
+        if header_end < 0 or seq_end < 0 or plus_end < 0 or (qual_end < 0 and not final):
+            if not final:
+                return position
+            if buffer[position:end].strip():
+                raise ValueError("Truncated fastq record at byte {}".format(offset + position))
+            return end
+        if qual_end < 0:
+            qual_end = end
+        if buffer[position:position + 1] != b"@" or buffer[seq_end + 1:seq_end + 2] != b"+":
+            raise ValueError("Malformed fastq record at byte {}".format(offset + position))
+        yield (buffer[position + 1:header_end].rstrip(b"\r"),
+               buffer[header_end + 1:seq_end].rstrip(b"\r"),
+               buffer[plus_end + 1:qual_end].rstrip(b"\r"))
+        position = qual_end + 1
+    return position
+
+
+def read_fasta(path):
+    """
+    Generator of (header, sequence) byte strings for every record of a fasta file. The header excludes the leading >
+    and sequences wrapped over several lines are joined.
+    :param path:
+    :return:
+    """
+    with open_binary(path) as f:
+        buffer = map_file(f) if compression(path) is None else f
+        if isinstance(buffer, mmap.mmap):
+            try:
+                yield from parse_fasta(buffer)
+            finally:
+                buffer.close()
+        else:
+            yield from parse_fasta(f.read())
+
+
+def parse_fasta(buffer):
+    """
+    Generator of (header, sequence) byte strings from a bytes-like buffer of fasta text
+    :param buffer: bytes or mmap
+    :return:
+    """
+    position = buffer.find(b">")
+    if position < 0:
+        return
+    end = len(buffer)
+    while position < end:
+        header_end = buffer.find(b"\n", position)
+        if header_end < 0:
+            header_end = end
+        record_end = buffer.find(b"\n>", header_end)
+        if record_end < 0:
+            record_end = end
+        header = buffer[position + 1:header_end].rstrip(b"\r")
+        seq = buffer[header_end + 1:record_end]
+        if b"\n" in seq:
+            seq = b"".join(seq.split())
+        else:
+            seq = seq.rstrip(b"\r")
+        yield header, seq
+        position = record_end + 1
+
+
+def record_id(header):
+    # Identifier of a record, the header up to the first whitespace, as Biopython uses for SeqRecord.id
+    return header.split(None, 1)[0] if header else header
+
+
+def format_fastq(header, seq, qual):
+    # Fastq text of a single record as bytes
+    return b"@%s\n%s\n+\n%s\n" % (header, seq, qual)
+
+
+def write_fastq(handle, header, seq, qual):
+    """
+    Writes a single fastq record to a binary handle
+    """
+    handle.write(format_fastq(header, seq, qual))
+
+
+def write_fasta(handle, header, seq, width=60):
+    """
+    Writes a single fasta record to a binary handle, wrapping the sequence every width bases as Biopython does. A width
+    of 0 writes the sequence on a single line.
+    """
+    handle.write(b">%s\n" % header)
+    if width and len(seq) > width:
+        for start in range(0, len(seq), width):
+            handle.write(seq[start:start + width] + b"\n")
+    else:
+        handle.write(seq + b"\n")
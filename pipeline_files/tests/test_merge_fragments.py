@@ -0,0 +1,73 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from merge_fragments import merge_fragments, write_report
+
+
+def random_sequence(length, seed):
+    generator = random.Random(seed)
+    return bytes(generator.choice(b"ACGT") for _ in range(length))
+
+
+class TestMergeFragments(unittest.TestCase):
+
+    def setUp(self):
+        # A 646 bp contig read as the 430 bp fragment A and the 415 bp fragment B, which share 199 bases
+        self.contig = random_sequence(646, 1)
+        self.a = self.contig[:430]
+        self.b = self.contig[231:]
+
+    def test_expected_geometry(self):
+        result = merge_fragments("A;size=30", self.a, "B;size=20", self.b)
+        self.assertEqual(self.contig, result["sequence"])
+        self.assertFalse(result["swapped"])
+        self.assertEqual(646, result["length"])
+        self.assertEqual(199, result["identity"])
+
+        directory = tempfile.mkdtemp()
+        try:
+            report = os.path.join(directory, "sample.merger")
+            write_report(result, report)
+            with open(report) as handle:
+                lines = handle.readlines()
+        finally:
+            shutil.rmtree(directory)
+        self.assertIn("# Identity:     199/646 (30.8%)", lines[22])
+
+    def test_swapped_order(self):
+        result = merge_fragments("B;size=30", self.b, "A;size=20", self.a)
+        self.assertEqual(self.contig, result["sequence"])
+        self.assertTrue(result["swapped"])
+        self.assertEqual("A;size=20", result["a_name"])
+
+    def test_indel_in_overlap(self):
+        # A base of the overlap missing from fragment B
+        b = self.b[:20] + self.b[21:]
+        result = merge_fragments("A", self.a, "B", b)
+        self.assertEqual(self.contig, result["sequence"])
+        self.assertEqual(198, result["identity"])
+        self.assertEqual(646, result["length"])
+
+    def test_overlap_outside_band(self):
+        # Fragment A ends 25 to 40 bases from the expected overlap, beyond the band of 20 diagonals
+        for length in (400, 455, 470):
+            result = merge_fragments("A", self.contig[:length], "B", self.b)
+            self.assertEqual(self.contig, result["sequence"])
+            self.assertEqual(length - 231, result["identity"])
+            self.assertGreater(result["band"], 20)
+
+    def test_no_overlap(self):
+        with self.assertRaises(ValueError):
+            merge_fragments("A", self.a, "B", random_sequence(415, 2))
+
+    def test_overlap_beyond_max_band(self):
+        # Two variants of fragment A overlap end to end, far outside the overlaps of a fragment A and B pair
+        variant = self.a[:100] + (b"A" if self.a[100:101] != b"A" else b"C") + self.a[101:]
+        with self.assertRaises(ValueError):
+            merge_fragments("A", self.a, "A2", variant)
+        # Fragment A ending 130 bases past the expected overlap
+        with self.assertRaises(ValueError):
+            merge_fragments("A", self.contig[:560], "B", self.b)
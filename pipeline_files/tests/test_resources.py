@@ -0,0 +1,18 @@
+import unittest
+
+from resources import split_threads
+
+
+class TestSplitThreads(unittest.TestCase):
+
+    def test_shares_sum_to_threads(self):
+        for threads in range(3, 17):
+            shares = split_threads(threads, [60, 120, 12])
+            self.assertEqual(threads, sum(shares))
+            self.assertTrue(all(share >= 1 for share in shares))
+
+    def test_shares_follow_weights(self):
+        self.assertEqual([3, 4, 1], split_threads(8, [60, 120, 12]))
+
+    def test_one_thread_each_below_processes(self):
+        self.assertEqual([1, 1, 1], split_threads(2, [60, 120, 12]))
@@ -7,25 +7,99 @@ License: MIT
 """
 
 from Bio import SeqIO
-import subprocess
 import os
+import re
 import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+from collections import Counter, deque
+
+from seq_io import (IUPAC_CODES, STDIO, format_fastq, open_binary, parse_fastq, read_fastq, record_id,
+                    write_fasta)
+
+
+# Fragment B reverse primer hits at or before this index are ignored
+REVERSE_PRIMER_MIN_INDEX = 401
+
+# Number of reads handed to a worker process at a time when running with multiple threads
+CHUNK_SIZE = 2000
+
+# Primer index of a worker process, set once by init_worker
+WORKER_PRIMERS = None
 
 
 def main():
     parser = argparse.ArgumentParser(description='Trims Diptera CO1 merged reads of degenerate primers')
 
-    parser.add_argument('-f', type=str,
-                        help='Merged Read file in .fq format', required=True)
+    parser.add_argument('-f', type=str, nargs='+',
+                        help='Merged Read file(s) in .fq format, - to read a single sample from stdin')
     parser.add_argument('-p', type=str,
                         help='Primer File in .fasta format', required=True)
-    parser.add_argument('-o', type=str,
-                        help='Output file', required=True)
-    parser.add_argument('-dg', type=str,
-                        help='Path to degenerate oligo Script', default="pipeline_files/dg")
+    parser.add_argument('-o', type=str, nargs='+',
+                        help='Output file(s), one per merged read file. - writes a single sample\'s sliced reads to '
+                             'stdout, and its log to stderr')
+    parser.add_argument('-u', type=str,
+                        help='Unfiltered output of a single sample, by default the output file with .fq replaced by '
+                             '_unfiltered.fq, or not written when the output is stdout')
+    parser.add_argument('-n', '--name', type=str,
+                        help='File name reported in the log of a single sample, such as when reading stdin')
+    parser.add_argument('-l', type=str, nargs='+',
+                        help='Log file(s), one per merged read file. Logs are printed if omitted')
+    parser.add_argument('-d', '--derep', type=str, nargs='+',
+                        help='Dereplicated fasta file(s) with ;size=N abundances, one per merged read file. '
+                             'Sliced outputs are optional when given')
+    parser.add_argument('-s', '--stats', type=str, nargs='+',
+                        help='JSON file(s) of trimming statistics, one per merged read file')
+    parser.add_argument('-m', type=str,
+                        help='Tab separated manifest of merged read file, output file and optional log file, '
+                             'dereplicated fasta and statistics per line, in place of -f, -o, -l, -d and -s')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Number of worker processes', default=1)
     args = parser.parse_args()
 
-    find_primers(args.f, args.p, args.o, args.dg)
+    if args.m:
+        samples = read_manifest(args.m)
+    elif args.f and (args.o or args.derep) and \
+            all(len(files) == len(args.f) for files in (args.o, args.l, args.derep, args.stats) if files):
+        none = [None] * len(args.f)
+        samples = list(zip(args.f, args.o or none, args.l or none, args.derep or none, args.stats or none))
+    else:
+        parser.error("Provide a manifest with -m, or the same number of -f and -o (or -d) files, and -l and -s if "
+                     "used")
+
+    if len(samples) == 1 and samples[0][2] is None:
+        fastq_file, output_file, _, derep_file, stats_file = samples[0]
+        find_primers(fastq_file, args.p, output_file, args.threads, derep_file, args.u, args.name, stats_file)
+    elif args.u or args.name or any(STDIO in sample for sample in samples):
+        parser.error("stdin, stdout, -u and -n can only be used with a single sample and no log file")
+    else:
+        find_primers_batch(samples, args.p, args.threads)
+
+
+def read_manifest(manifest):
+    """
+    Reads a tab separated manifest of merged read file, output file, and optional log file, dereplicated fasta and
+    statistics. Empty columns are treated as not given.
+    :param manifest:
+    :return: List of (fastq_file, output_file, log_file, derep_file, stats_file) tuples, None for files not given
+    """
+    samples = []
+    with open(manifest) as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            columns = line.rstrip("\n").split("\t")
+            if 2 <= len(columns) <= 5:
+                columns = [column or None for column in columns] + [None] * (5 - len(columns))
+            if len(columns) != 5 or not columns[0] or not (columns[1] or columns[3]):
+                raise ValueError("Manifest line needs a merged read file and an output file or dereplicated "
+                                 "fasta: {}".format(line.rstrip()))
+            samples.append(tuple(columns))
+    return samples
 
 
 def get_primers(file):
@@ -44,103 +118,377 @@ def get_primers(file):
     return primer_sequences
 
 
-def find_primers(fastq_file, primer_file, output_file, dg):
+def compile_degenerate_primer(primer):
+    """
+    Compiles a degenerate primer into a regular expression that matches every oligo the primer encodes, so reads can be
+    searched for all of them in a single pass instead of expanding the oligos and searching for each in turn.
+    :param primer: Primer sequence containing IUPAC codes
+    :return: Compiled pattern
+    """
+    pattern = ""
+    for base in primer.upper():
+        if base not in IUPAC_CODES:
+            raise ValueError("Bad base in {} ({})".format(primer, base))
+        bases = IUPAC_CODES[base]
+        pattern += bases if len(bases) == 1 else "[{}]".format(bases)
+    return re.compile(pattern.encode())
+
+
+def compile_primers(primer_file):
+    """
+    Builds the primer index used while trimming: the fragment A forward primer and a compiled matcher for the
+    degenerate fragment B reverse primer. Built once per run.
+    :param primer_file:
+    :return: Tuple of fragment A forward primer and fragment B reverse primer pattern
+    """
+    primers = get_primers(primer_file)
+    primer_a_f = str(primers[0].seq).encode() # Forward primer Fragment A
+    primer_b_r = str(primers[3].seq) # Reverse Degenerate Primer Fragment B
+    return primer_a_f, compile_degenerate_primer(primer_b_r)
+
+
+def find_primers(fastq_file, primer_file, output_file, threads=1, derep_file=None, unfiltered_file=None, name=None,
+                 stats_file=None):
     """
     Scans reads for forward or reverse primers. If fragment A, removes everything before the forward primer, and
     removes the degenerate reverse primer. If fragment B, removed the degenerate forward primer, and everything beyond
     the reverse primer. Also eliminates any reads that are too short, or have no primers detected. The remaining reads
     can properly assembly without any internal degeneracy.
 
+    Reads are streamed from the input and written to the sliced and unfiltered outputs as they are processed, so
+    memory use does not grow with the depth of the sample. With more than one thread, reads are trimmed in chunks by a
+    pool of worker processes and written back in input order.
+
     -----------------------
     Forward A       --------------------
                                Reverse B
+    Either file may be "-" for stdin or stdout, so the script can sit in a pipe after bbmerge. The log is printed to
+    stderr when the sliced reads go to stdout.
     :param fastq_file:
     :param primer_file:
-    :param output_file:
-    :param dg: Script to generate oligos of degenerate primers
+    :param output_file: Sliced output, None to only write the dereplicated fasta
+    :param threads: Number of worker processes
+    :param derep_file: Optional fasta of the dereplicated sliced reads, as vsearch --derep_fulllength writes
+    :param unfiltered_file: Optional unfiltered output, in place of the one named after output_file
+    :param name: File name reported in the log, fastq_file if None
+    :param stats_file: Optional JSON file of trimming statistics
     :return:
     """
-    with open(fastq_file) as f:
-        primers = get_primers(primer_file)
-        primer_a_f = str(primers[0].seq) # Forward primer Fragment A
-        primer_b_r = str(primers[3].seq) # Reverse Degenerate Primer Fragment B
+    primer_index = compile_primers(primer_file)
+    with create_pool(primer_index, threads) as pool:
+        counts = trim_sample(fastq_file, output_file, primer_index, pool, threads, derep_file, unfiltered_file)
+    print(format_log(name or fastq_file, counts), file=sys.stderr if output_file == STDIO else sys.stdout)
+    if stats_file:
+        write_stats(name or fastq_file, counts, stats_file)
+    return counts
+
+
+def find_primers_batch(samples, primer_file, threads=1):
+    """
+    Trims every sample of a plate in a single process. The primer index and the worker pool are built once and shared
+    by all samples. Each sample's outputs and log line are the same as a run of find_primers on that sample alone.
+    :param samples: List of (fastq_file, output_file, log_file, derep_file, stats_file) tuples, the log line is
+    printed if log_file is None
+    :param primer_file:
+    :param threads: Number of worker processes
+    :return: List of counts per sample
+    """
+    primer_index = compile_primers(primer_file)
+    all_counts = []
+    with create_pool(primer_index, threads) as pool:
+        for fastq_file, output_file, log_file, derep_file, stats_file in samples:
+            counts = trim_sample(fastq_file, output_file, primer_index, pool, threads, derep_file)
+            log_string = format_log(fastq_file, counts)
+            if log_file:
+                with open(log_file, "w") as f:
+                    f.write(log_string + "\n")
+            else:
+                print(log_string)
+            if stats_file:
+                write_stats(fastq_file, counts, stats_file)
+            all_counts.append(counts)
+    return all_counts
+
+
+def create_pool(primer_index, threads):
+    # Worker pool sharing the primer index, or an empty context when trimming in this process
+    if threads > 1:
+        return multiprocessing.Pool(threads, initializer=init_worker, initargs=primer_index)
+    return contextlib.nullcontext()
+
+
+def trim_sample(fastq_file, output_file, primer_index, pool=None, threads=1, derep_file=None, unfiltered_file=None):
+    """
+    Trims a single merged read file into its sliced output file and the matching _unfiltered file. If derep_file is
+    given, identical sliced reads are also counted as they stream past and written to derep_file, so the sliced file
+    doesn't need to be read back by vsearch.
+    :param fastq_file:
+    :param output_file: Sliced output, None to skip the sliced and unfiltered outputs
+    :param primer_index: Tuple of fragment A forward primer and fragment B reverse primer pattern
+    :param pool: Worker pool from create_pool, None to trim in this process
+    :param threads: Number of workers in the pool
+    :param derep_file: Optional fasta of the dereplicated sliced reads
+    :param unfiltered_file: Unfiltered output, by default named after output_file. Not written if output_file is
+    stdout and no unfiltered_file is given
+    :return: Counts of each outcome, with the histograms and timings of write_stats under tuple keys
+    """
+    start = time.perf_counter()
+    primer_a_f, primer_b_r = primer_index
+    counts = Counter()
+    abundances = {}
+    if output_file and not unfiltered_file and output_file != STDIO:
+        unfiltered_file = output_file.replace(".fq", "_unfiltered.fq")
+    with contextlib.ExitStack() as stack:
+        if output_file:
+            g = stack.enter_context(open_binary(output_file, "wb"))
+        if unfiltered_file:
+            h = stack.enter_context(open_binary(unfiltered_file, "wb"))
+        if pool is not None:
+            results = slice_chunks_in_parallel(fastq_file, pool, threads, counts)
+        else:
+            results = slice_chunks(fastq_file, primer_a_f, primer_b_r, counts)
+        for sliced, unfiltered in results:
+            # Write sliced reads to output file, unsliced reads to unfiltered output file
+            written = time.perf_counter()
+            if output_file:
+                g.write(sliced)
+            if unfiltered_file:
+                h.write(unfiltered)
+            counted = time.perf_counter()
+            counts[("seconds", "write")] += counted - written
+            # Counting reparses the sliced reads, so it's timed with parsing
+            if derep_file and sliced:
+                count_sequences(sliced, abundances)
+                counts[("seconds", "parse")] += time.perf_counter() - counted
+
+    if derep_file:
+        written = time.perf_counter()
+        write_dereplicated(abundances, derep_file)
+        counts[("seconds", "write")] += time.perf_counter() - written
+    counts[("seconds", "total")] += time.perf_counter() - start
+    return counts
+
+
+def count_sequences(sliced, abundances):
+    """
+    Tallies identical sequences of sliced fastq text. Abundances maps each sequence to a list of its count and the
+    label of the first read it was seen in, in order of first appearance.
+    """
+    for header, seq, _ in parse_fastq(sliced):
+        abundance = abundances.get(seq)
+        if abundance is None:
+            abundances[seq] = [1, record_id(header)]
+        else:
+            abundance[0] += 1
+
+
+def write_dereplicated(abundances, derep_file):
+    """
+    Writes dereplicated sequences the way vsearch --derep_fulllength --sizeout --fasta_width 0 does: sorted by
+    decreasing abundance, ties in order of first appearance, labelled by their first read with a ;size=N suffix.
+    """
+    ranked = sorted(abundances.items(), key=lambda item: -item[1][0])
+    with open_binary(derep_file, "wb") as f:
+        for seq, (size, label) in ranked:
+            write_fasta(f, b"%s;size=%d" % (label, size), seq, width=0)
+
+
+def format_log(fastq_file, counts):
+    return "File {}, Total Reads: {}, Missing Primers: {}, Reads Too Short: {}, Fragment A Reads: {}, " \
+           "Fragement B Reads: {}, Filtered Out Reads: {}".format(os.path.basename(fastq_file),
+                                                                  counts["total"], counts["no_primers"],
+                                                                  (counts["too_short_a"]+counts["too_short_b"]),
+                                                                  counts["fragment_a"], counts["fragment_b"],
+                                                                  counts["filtered_out"])
+
+
+def write_stats(fastq_file, counts, stats_file):
+    """
+    Writes the statistics of a sample as JSON: the counts of the log, the reasons reads were rejected by fragment,
+    histograms of primer hit positions and read lengths, and the seconds spent parsing, searching and writing. Counting
+    the reads to dereplicate is part of parsing, and writing them part of writing. With worker processes, parse and
+    search are summed over the workers and can exceed the total.
+    """
+    histograms = {"forward_primer_position": {}, "reverse_primer_position": {}, "read_length": {}}
+    seconds = {"parse": 0.0, "search": 0.0, "write": 0.0, "total": 0.0}
+    for key, value in counts.items():
+        if isinstance(key, tuple):
+            name, bin = key
+            if name == "seconds":
+                seconds[bin] = round(value, 6)
+            else:
+                histograms[name][bin] = value
+    stats = {
+        "file": os.path.basename(fastq_file),
+        "counts": dict((key, counts[key]) for key in ("total", "fragment_a", "fragment_b", "filtered_out")),
+        "rejected": {
+            "fragment_a": {"too_short": counts["too_short_a"]},
+            "fragment_b": {"too_short": counts["too_short_b"]},
+            "unknown": {"no_primers": counts["no_primers"]},
+        },
+        "seconds": seconds,
+        "reads_per_second": round(counts["total"] / seconds["total"], 1) if seconds["total"] else None,
+    }
+    for name, histogram in histograms.items():
+        stats[name] = dict((str(bin), histogram[bin]) for bin in sorted(histogram))
+    with open(stats_file, "w") as f:
+        json.dump(stats, f, indent=1)
+
+
+def format_sliced_reads(reads, primer_a_f, primer_b_r, counts):
+    """
+    Generator of fastq text for every read, as a tuple of sliced read bytes and unfiltered read bytes. One of the two
+    is always empty.
+    """
+    for seq, cut_read in slice_reads(reads, primer_a_f, primer_b_r, counts):
+        if cut_read is not None:
+            yield format_fastq(*cut_read), b""
+        else:
+            yield b"", format_fastq(*seq)
+
+
+def slice_chunks(fastq_file, primer_a_f, primer_b_r, counts, chunk_size=CHUNK_SIZE):
+    """
+    Trims reads in this process chunk_size reads at a time, yielding the sliced and unfiltered text of each chunk.
+    Parsing and searching each chunk are timed separately, which costs a pair of clock reads per chunk rather than per
+    read.
+    """
+    reads = read_fastq(fastq_file)
+    while True:
+        start = time.perf_counter()
+        chunk = list(itertools.islice(reads, chunk_size))
+        parsed = time.perf_counter()
+        if not chunk:
+            counts[("seconds", "parse")] += parsed - start
+            return
+        sliced_reads = []
+        unfiltered_reads = []
+        for sliced, unfiltered in format_sliced_reads(chunk, primer_a_f, primer_b_r, counts):
+            sliced_reads.append(sliced)
+            unfiltered_reads.append(unfiltered)
+        counts[("seconds", "parse")] += parsed - start
+        counts[("seconds", "search")] += time.perf_counter() - parsed
+        yield b"".join(sliced_reads), b"".join(unfiltered_reads)
 
-        # Degenerate primers must be converted into their respective oligos for detection in the reads
-        # Uses the dg program compiled from Author Pierre Lindenbaum https://www.biostars.org/p/6219/
-        dg_result = subprocess.run(['./{}'.format(dg), primer_b_r], stdout=subprocess.PIPE).stdout.decode('utf-8')
-        reverse_primers = dg_result.split('\n')[:-1]
 
-        curated_fragment_a_reads = []
-        curated_fragment_b_reads = []
-        total_reads = 0
-        too_short_a = 0
-        too_short_b = 0
-        no_primers = 0
-        filtered_out_reads = []
+def read_chunks(fastq_file, chunk_size=CHUNK_SIZE):
+    """
+    Generator of the raw bytes of chunk_size reads at a time from a 4 line per record fastq file. Reads are only parsed
+    by the worker processes, so the parent process just moves bytes.
+    """
+    with open_binary(fastq_file) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size * 4))
+            if not lines:
+                return
+            yield b"".join(lines)
 
-        for seq in SeqIO.parse(f, "fastq"):
 
-            total_reads += 1
-            sliced_seq = False
+def init_worker(primer_a_f, primer_b_r):
+    # Shares the primer index with each worker process once, rather than sending it along with every chunk
+    global WORKER_PRIMERS
+    WORKER_PRIMERS = (primer_a_f, primer_b_r)
 
+
+def slice_chunk(chunk):
+    """
+    Trims one chunk of fastq bytes in a worker process.
+    :return: Tuple of sliced read bytes, unfiltered read bytes and the chunk's counts
+    """
+    counts = Counter()
+    sliced_reads = []
+    unfiltered_reads = []
+    start = time.perf_counter()
+    reads = list(parse_fastq(chunk))
+    parsed = time.perf_counter()
+    for sliced, unfiltered in format_sliced_reads(reads, WORKER_PRIMERS[0], WORKER_PRIMERS[1], counts):
+        sliced_reads.append(sliced)
+        unfiltered_reads.append(unfiltered)
+    counts[("seconds", "parse")] += parsed - start
+    counts[("seconds", "search")] += time.perf_counter() - parsed
+    return b"".join(sliced_reads), b"".join(unfiltered_reads), counts
+
+
+def slice_chunks_in_parallel(fastq_file, pool, threads, counts):
+    """
+    Fans chunks of reads out to a pool of worker processes and yields their sliced and unfiltered text in input order.
+    Only a couple of chunks per worker are in flight at once, so memory stays bounded. Counts of every chunk are added
+    to counts as the chunk is yielded.
+    """
+    pending = deque()
+    for chunk in read_chunks(fastq_file):
+        pending.append(pool.apply_async(slice_chunk, (chunk,)))
+        if len(pending) >= threads * 2:
+            sliced, unfiltered, chunk_counts = pending.popleft().get()
+            counts.update(chunk_counts)
+            yield sliced, unfiltered
+    while pending:
+        sliced, unfiltered, chunk_counts = pending.popleft().get()
+        counts.update(chunk_counts)
+        yield sliced, unfiltered
+
+
+def slice_reads(reads, primer_a_f, primer_b_r, counts):
+    """
+    Generator that trims each read as it is parsed. Yields a tuple of the original read and the sliced read, where the
+    sliced read is None if the read was filtered out. Tallies of each outcome are added to counts as reads pass through,
+    along with histograms of read lengths and primer hit positions under ("read_length", length),
+    ("forward_primer_position", index) and ("reverse_primer_position", index) keys.
+    :param reads: Iterable of (header, sequence, quality) byte strings
+    :param primer_a_f: Fragment A forward primer
+    :param primer_b_r: Compiled pattern of the degenerate fragment B reverse primer
+    :param counts: Counter updated in place
+    :return:
+    """
+    for seq in reads:
+        header, bases, quality = seq
+
+        counts["total"] += 1
+        counts[("read_length", len(bases))] += 1
+        cut_read = None
+
+        """
+        Look for fragment A primer in read. If found, trim the read to the minimum_fragement length, 
+        which excludes the degenerate reverse primer.
+        """
+        index = bases.find(primer_a_f)
+        if index >= 0:
+            counts[("forward_primer_position", index)] += 1
+        if index > 0: # Fragment A Forward Primer Found
+            min_size = 454 # Forward Primer + Fragment A without Reverse Primer
+            if len(bases) >= index + min_size:  # Fragment is minimum size without including degenerate primer
+                start, end = index+len(primer_a_f), index+min_size+1 # Cut off Forward and Reverse Primer's
+                cut_read = (header, bases[start:end], quality[start:end])
+                if len(cut_read[1]) == 430:
+                    counts["fragment_a"] += 1
+                else:
+                    cut_read = None
+                    counts["too_short_a"] += 1
+            else:
+                counts["too_short_a"] += 1
+        else:
             """
-            Look for fragment A primer in read. If found, trim the read to the minimum_fragement length, 
-            which excludes the degenerate reverse primer.
+            Since fragment a forward primer wasn't found, likely dealing with fragment B read
+            Look for the reverse primer, since its degenerate match any of its oligos, only past the position
+            where fragment B's reverse primer is expected. Then trim the read to just the reverse primer at tail,
+            and trim the first 20 bases to capture the degenerate forward primer
             """
-            index = seq.seq.find(primer_a_f)
-            if index > 0: # Fragment A Forward Primer Found
-                min_size = 454 # Forward Primer + Fragment A without Reverse Primer
-                if len(seq.seq) >= index + min_size:  # Fragment is minimum size without including degenerate primer
-                    cut_read = seq[index+len(primer_a_f):index+min_size+1] # Cut off Forward and Reverse Primer's
-                    if len(cut_read.seq) == 430:
-                        curated_fragment_a_reads.append(cut_read)
-                        sliced_seq = True
-                    else:
-                        too_short_a += 1
+            match = primer_b_r.search(bases, REVERSE_PRIMER_MIN_INDEX)
+            if match:
+                index = match.start()
+                counts[("reverse_primer_position", index)] += 1
+                if len(bases) > 450: # Contains both B fragment primers
+                    cut_read = (header, bases[index-415:index], quality[index-415:index]) # Remove the primers
+                    counts["fragment_b"] += 1
                 else:
-                    too_short_a += 1
+                    counts["too_short_b"] += 1
             else:
-                """
-                Since fragment a forward primer wasn't found, likely dealing with fragment B read
-                Look for the reverse primer, since its degenerate look at all possible oligos. 
-                Then trim the read to just the reverse primer at tail, and trim the first 20 bases to 
-                capture the degenerate forward primer
-                """
-
-                for primer in reverse_primers:
-                    temp_index = seq.seq.find(primer)
-                    if temp_index > 400:
-                        index = temp_index
-                        if len(seq.seq) > 450: # Contains both B fragment primers
-                            cut_read = seq[index-415:index] # Remove the forward and reverse primers
-                            curated_fragment_b_reads.append(cut_read)
-                            sliced_seq = True
-                        else:
-                            too_short_b += 1
-                        break
-                else:
-                    no_primers += 1
-
-            if not sliced_seq:
-                filtered_out_reads.append(seq)
-
-        log_string = "File {}, Total Reads: {}, Missing Primers: {}, Reads Too Short: {}, Fragment A Reads: {}, " \
-                     "Fragement B Reads: {}, Filtered Out Reads: {}".format(os.path.basename(fastq_file),
-                                                                            total_reads, no_primers,
-                                                    (too_short_a+too_short_b),
-                                                    len(curated_fragment_a_reads), len(curated_fragment_b_reads),
-                                                                            len(filtered_out_reads))
-        print(log_string)
-
-        # Write sliced reads to output file
-        curated_reads = curated_fragment_a_reads + curated_fragment_b_reads
-        with open(output_file, "w") as g:
-            SeqIO.write(curated_reads, g, "fastq")
-
-        # Write unsliced reads to output file
-        unfiltered_output_file = output_file.replace(".fq", "_unfiltered.fq")
-        with open(unfiltered_output_file, "w") as h:
-            SeqIO.write(filtered_out_reads, h, "fastq")
+                counts["no_primers"] += 1
+
+        if cut_read is None:
+            counts["filtered_out"] += 1
+
+        yield seq, cut_read
 
 
 if __name__ == "__main__":